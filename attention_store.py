@@ -0,0 +1,67 @@
+import glob
+import os
+import numpy as np
+import torch
+
+class AttentionRecorder(object):
+    """
+    Samples attention maps during training and writes them as compressed
+    float16 .npz files for attention_viewer.py. Every `every`-th training step
+    is recorded (LAS.forward is only asked for attentions on those steps);
+    of such a batch, `utterances` random utterances are kept, every
+    `step_stride`-th decoder step, cropped to the utterance's encoder and
+    transcript length. One file <store_dir>/<epoch>-<step>.npz holds
+    attention_<k> (decoder steps * encoder frames) and steps_<k> (the decoder
+    step of every row) for each kept utterance k. With windowed attention the
+    maps hold the attention window of each step, not encoder frames.
+    """
+    def __init__(self, store_dir, every=100, utterances=1, step_stride=1, seed=0):
+        self.store_dir = store_dir
+        self.every = every
+        self.utterances = utterances
+        self.step_stride = step_stride
+        self.rng = np.random.RandomState(seed)
+        os.makedirs(store_dir, exist_ok=True)
+
+    def wants(self, step):
+        return self.every > 0 and step % self.every == 0
+
+    def record(self, epoch, step, attentions, encoder_lengths, targets_length):
+        """
+        attentions: list of batch_size * 1 * T attentions from LAS.forward
+        encoder_lengths: Listener outputs_length
+        targets_length: decoded steps of every utterance (targets_length_for_loss)
+        """
+        if len(attentions) == 0:
+            return
+        batch_size = attentions[0].shape[0]
+        rows = np.sort(self.rng.choice(batch_size, min(self.utterances, batch_size), replace=False))
+        steps = np.arange(0, len(attentions), self.step_stride)
+        # kept utterances * kept steps * T, copied to the host once
+        maps = torch.cat([attentions[i][rows] for i in steps], dim=1)
+        maps = maps.to(torch.float16).cpu().numpy()
+        arrays = {"batch_rows": rows}
+        for k, row in enumerate(rows):
+            nsteps = np.searchsorted(steps, targets_length[row])
+            arrays["attention_{}".format(k)] = maps[k, :nsteps, :int(encoder_lengths[row])]
+            arrays["steps_{}".format(k)] = steps[:nsteps]
+        path = os.path.join(self.store_dir, "{}-{}.npz".format(epoch, step))
+        np.savez_compressed(path, **arrays)
+
+def load_maps(path):
+    """
+    return: list of (batch_row, decoder steps, steps * frames float32 attention)
+    """
+    with np.load(path) as store:
+        rows = store["batch_rows"]
+        return [(int(row), store["steps_{}".format(k)], store["attention_{}".format(k)].astype(np.float32))
+                for k, row in enumerate(rows)]
+
+def list_maps(store_dir):
+    """
+    return: .npz paths of a store, ordered by epoch and step
+    """
+    def key(path):
+        epoch, step = os.path.basename(path)[:-len(".npz")].split("-")
+        return int(epoch), int(step)
+    return sorted(glob.glob(os.path.join(store_dir, "*.npz")), key=key)
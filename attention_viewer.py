@@ -0,0 +1,73 @@
+import argparse
+import os
+import torch
+from torch.utils.data import DataLoader
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from attention_store import list_maps, load_maps
+from config import MODEL_CONFIG as CONF
+from model import load_las
+from myDataset import myDataset, collate_seq
+
+def plot_map(attention, steps, title, path):
+    """
+    attention: recorded decoder steps * encoder frames
+    steps: decoder step of every row
+    """
+    figure, axes = plt.subplots()
+    axes.imshow(attention, cmap='hot', aspect='auto', interpolation='nearest')
+    if len(steps) > 1:
+        stride = steps[1] - steps[0]
+        axes.set_ylabel("decoder step / {}".format(stride))
+    else:
+        axes.set_ylabel("decoder step")
+    axes.set_xlabel("encoder frame")
+    axes.set_title(title)
+    figure.savefig(path)
+    plt.close(figure)
+
+def attention_map(dev_loader, model, path):
+    """
+    Plot the attention of the first utterance of the first dev batch.
+    """
+    with torch.no_grad():
+        inputs, targets = next(iter(dev_loader))
+        _, _, _, _, attentions = model(inputs, targets, teacher_forcing=0.9,
+                                       record_attention=True)
+    data = torch.cat(attentions, dim=1)[0].cpu().numpy()
+    plot_map(data, list(range(len(attentions))), "dev utterance 0", path)
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.weights is not None:
+        model = load_las(CONF, args.weights).eval()
+        dev_set = myDataset(args.dev_data, args.dev_transcripts)
+        loader = DataLoader(dev_set, shuffle=False, batch_size=CONF["batch_size"], collate_fn=collate_seq)
+        path = os.path.join(args.output_dir, "dev.png")
+        attention_map(loader, model, path)
+        print("wrote", path)
+        return
+    for store_path in list_maps(args.store_dir)[-args.last:]:
+        name = os.path.basename(store_path)[:-len(".npz")]
+        for row, steps, attention in load_maps(store_path):
+            path = os.path.join(args.output_dir, "{}-row{}.png".format(name, row))
+            plot_map(attention, steps, "epoch-step {}, batch row {}".format(name, row), path)
+            print("wrote", path)
+
+def arguments():
+    parser = argparse.ArgumentParser(description="plot attention maps recorded by train.py --attention-dir")
+    parser.add_argument('--store-dir', type=str, default="./attention")
+    parser.add_argument('--last', type=int, default=10,
+                        help='plot the most recent N recorded batches')
+    parser.add_argument('--output-dir', type=str, default="./attention_plots")
+    parser.add_argument('--weights', type=str, default=None,
+                        help='instead of the store, plot a fresh dev attention map of this checkpoint')
+    parser.add_argument('--dev-data', type=str, default="./data/dev.npy")
+    parser.add_argument('--dev-transcripts', type=str, default="./data/dev_char.npy")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
@@ -0,0 +1,81 @@
+import argparse
+import time
+import numpy as np
+import torch
+
+from bench_decoding import build_model, load_utterances, batches
+from config import MODEL_CONFIG as CONF
+from metrics import error_rates
+
+def decode(model, utterances, batch_size, beam_width, window):
+    model.speller.attention_window = window
+    hyps = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for inputs in batches(utterances, batch_size):
+            hyps += [p.tolist() for p in model.inference(inputs, None, beam_width=beam_width)]
+    return hyps, time.perf_counter() - start
+
+def step_time(model, utterances, batch_size, window, repeat):
+    """
+    Median time of one decoder step on the longest batch.
+    """
+    speller = model.speller
+    speller.attention_window = window
+    inputs = next(batches(sorted(utterances, key=len, reverse=True), batch_size))
+    times = []
+    with torch.no_grad():
+        listener_output, outputs_length = model.listener(inputs)
+        key, value, attention_mask = speller.attention.project(listener_output, outputs_length)
+        state = speller.initial_state(len(inputs))
+        context, _ = speller.attention.attend(state[2], key, value, attention_mask)
+        embed = speller.embed(torch.zeros(len(inputs), dtype=torch.long, device=key.device))
+        for _ in range(repeat):
+            start = time.perf_counter()
+            speller.step(embed, context, state, key, value, attention_mask)
+            times.append(time.perf_counter() - start)
+    return float(np.median(times)), key.shape[2]
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model = build_model(args.weights)
+    utterances = load_utterances(args.data, args.nutterances, args.min_len, args.max_len, args.seed)
+    # warm up so that allocator and thread pool start-up is not timed
+    decode(model, utterances[:args.batch_size], args.batch_size, 1, 0)
+
+    reference, reference_time = decode(model, utterances, args.batch_size, args.beam_width, 0)
+    full_step, longest = step_time(model, utterances, args.batch_size, 0, args.repeat)
+    print("{} utterances of {}-{} frames, longest encoder output {} frames".format(
+        len(utterances), min(len(u) for u in utterances), max(len(u) for u in utterances), longest))
+    print("    full: step {:7.3f}ms, decode {:7.2f}s".format(1000 * full_step, reference_time))
+    for window in args.windows:
+        hyps, elapsed = decode(model, utterances, args.batch_size, args.beam_width, window)
+        step, _ = step_time(model, utterances, args.batch_size, window, args.repeat)
+        identical = sum(h == r for h, r in zip(hyps, reference)) / float(len(reference))
+        # CER of the windowed hypotheses against full attention decoding
+        cer, _ = error_rates(hyps, reference)
+        print("{:>8}: step {:7.3f}ms, decode {:7.2f}s ({:.2f}x), identical {:.2f}, CER vs full {:.4f}".format(
+            "w={}".format(window), 1000 * step, elapsed, reference_time / elapsed, identical, cer))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="windowed vs full attention decoding")
+    parser.add_argument('--weights', type=str, default=None,
+                        help='checkpoint to load (default: random weights)')
+    parser.add_argument('--data', type=str, default=None,
+                        help='utterance .npy file (default: synthetic utterances)')
+    parser.add_argument('--nutterances', type=int, default=40)
+    parser.add_argument('--min-len', type=int, default=2000,
+                        help='shortest synthetic utterance in frames')
+    parser.add_argument('--max-len', type=int, default=3000,
+                        help='longest synthetic utterance in frames')
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"])
+    parser.add_argument('--beam-width', type=int, default=1)
+    parser.add_argument('--windows', type=int, nargs='+', default=[16, 32, 64])
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='timed decoder steps')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
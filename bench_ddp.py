@@ -0,0 +1,90 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from benchmark import cpu_only, synthetic_batch
+from config import MODEL_CONFIG as CONF
+from distributed import launch, init_worker, cleanup
+from model import load_las, sequence_loss
+
+def worker(rank, world_size, args, threads, result_queue):
+    """
+    Trains on synthetic batches (a different one per rank) and reports
+    (utterances, frames, seconds) of the timed steps from rank 0.
+    """
+    init_worker(rank, world_size, threads)
+    torch.manual_seed(args.seed)
+    model = load_las(CONF).train()
+    if world_size > 1:
+        model = DistributedDataParallel(model)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = nn.CrossEntropyLoss(reduction="sum")
+    rng = np.random.RandomState(args.seed + rank)
+    batches = [synthetic_batch(rng, args.batch_size, args.frames_mean, args.frames_std, args.chars_per_frame)
+               for _ in range(args.steps + 1)]
+
+    def step(inputs, targets):
+        probs, _, targets_for_loss, targets_length_for_loss, _ = model(inputs, targets, teacher_forcing=0.2)
+        loss, _ = sequence_loss(probs, targets_for_loss, targets_length_for_loss, criterion)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    # the first step builds the DDP buckets and warms up the kernels
+    step(*batches[0])
+    if world_size > 1:
+        dist.barrier()
+    start = time.perf_counter()
+    for inputs, targets in batches[1:]:
+        step(inputs, targets)
+    if world_size > 1:
+        dist.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        frames = sum(len(u) for inputs, _ in batches[1:] for u in inputs)
+        result_queue.put((world_size * args.steps * args.batch_size, world_size * frames, elapsed))
+    cleanup()
+
+def main(args):
+    cores = args.cores if args.cores is not None else os.cpu_count()
+    result_queue = mp.get_context("spawn").SimpleQueue()
+    print("{} cores, {} steps of {} utterances per process".format(cores, args.steps, args.batch_size))
+    baseline = None
+    for world_size in args.world_sizes:
+        threads = max(cores // world_size, 1)
+        os.environ["MASTER_PORT"] = str(args.port + world_size)
+        launch(worker, world_size, (args, threads, result_queue))
+        utterances, frames, elapsed = result_queue.get()
+        throughput = utterances / elapsed
+        if baseline is None:
+            baseline = throughput / world_size
+        print("{:>2} processes x {:>2} threads: {:7.2f} utterances/s, {:9.0f} frames/s, "
+              "scaling efficiency {:.2f}".format(world_size, threads, throughput, frames / elapsed,
+                                                 throughput / (baseline * world_size)))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="DistributedDataParallel (gloo) training throughput")
+    parser.add_argument('--world-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--cores', type=int, default=None,
+                        help='cores split between the processes (default: all)')
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"],
+                        help='utterances per process and step')
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--frames-mean', type=float, default=700)
+    parser.add_argument('--frames-std', type=float, default=150)
+    parser.add_argument('--chars-per-frame', type=float, default=0.15)
+    parser.add_argument('--port', type=int, default=29500)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    # gloo data parallelism is CPU only; spawned ranks inherit the hidden devices
+    cpu_only()
+    main(args)
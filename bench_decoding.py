@@ -0,0 +1,87 @@
+import argparse
+import time
+import numpy as np
+import torch
+
+from config import MODEL_CONFIG as CONF
+from model import load_las
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+def build_model(weights_path):
+    model = load_las(CONF, weights_path)
+    model.eval()
+    return model
+
+def load_utterances(data_path, nutterances, min_len, max_len, seed):
+    if data_path is not None:
+        data = np.load(data_path, encoding='bytes', allow_pickle=True)
+        return [torch.tensor(data[i]) for i in range(min(nutterances, len(data)))]
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(min_len, max_len + 1, size=nutterances)
+    return [torch.tensor(rng.randn(n, CONF["input_size"]).astype(np.float32)) for n in lengths]
+
+def batches(utterances, batch_size):
+    for i in range(0, len(utterances), batch_size):
+        batch = utterances[i:i + batch_size]
+        # the listener packs sequences, so sort each batch by length
+        yield sorted(batch, key=len, reverse=True)
+
+def time_decoding(model, utterances, batch_size, beam_width, length_penalty, timestep):
+    start = time.perf_counter()
+    nchars = 0
+    with torch.no_grad():
+        for inputs in batches(utterances, batch_size):
+            prediction_list = model.inference(inputs, None, timestep=timestep,
+                                              beam_width=beam_width,
+                                              length_penalty=length_penalty)
+            nchars += sum(len(p) for p in prediction_list)
+    elapsed = time.perf_counter() - start
+    return elapsed, nchars
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model = build_model(args.weights)
+    utterances = load_utterances(args.data, args.nutterances, args.min_len, args.max_len, args.seed)
+    print("{} utterances, batch size {}, device {}".format(len(utterances), args.batch_size, DEVICE))
+    # warm up so that allocator and thread pool start-up is not timed
+    time_decoding(model, utterances[:args.batch_size], args.batch_size, 1, args.length_penalty, args.timestep)
+
+    widths = [1] + [w for w in args.beam_widths if w > 1]
+    greedy_rate = None
+    for beam_width in widths:
+        elapsed, nchars = time_decoding(model, utterances, args.batch_size, beam_width,
+                                        args.length_penalty, args.timestep)
+        rate = len(utterances) / elapsed
+        if greedy_rate is None:
+            greedy_rate = rate
+        name = "greedy" if beam_width == 1 else "beam {}".format(beam_width)
+        print("{:>8}: {:8.2f} utt/s, {:8.1f} chars/s, {:5.2f}x greedy time".format(
+            name, rate, nchars / elapsed, greedy_rate / rate))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="LAS decoding benchmark")
+    parser.add_argument('--weights', type=str, default=None,
+                        help='checkpoint to load (default: random weights)')
+    parser.add_argument('--data', type=str, default=None,
+                        help='utterance .npy file (default: synthetic utterances)')
+    parser.add_argument('--nutterances', type=int, default=64,
+                        help='number of utterances to decode')
+    parser.add_argument('--min-len', type=int, default=200,
+                        help='shortest synthetic utterance in frames')
+    parser.add_argument('--max-len', type=int, default=1200,
+                        help='longest synthetic utterance in frames')
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"],
+                        help='decoding batch size')
+    parser.add_argument('--beam-widths', type=int, nargs='+', default=[2, 4, 8],
+                        help='beam widths to compare against greedy decoding')
+    parser.add_argument('--length-penalty', type=float, default=1.0,
+                        help='length normalization exponent for beam search')
+    parser.add_argument('--timestep', type=int, default=None,
+                        help='hard cap on decoded characters')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
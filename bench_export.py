@@ -0,0 +1,79 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+
+from bench_decoding import load_utterances
+from config import MODEL_CONFIG as CONF
+from export import export_las
+from model import load_las
+
+def time_load(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model = load_las(CONF, args.weights).eval()
+    checkpoint_path = args.weights
+    if checkpoint_path is None:
+        # a training checkpoint also carries the Adam state, so include it here too
+        checkpoint_path = os.path.join(args.workdir, "bench-checkpoint.pth")
+        optimizer = torch.optim.Adam(model.parameters())
+        for param in model.parameters():
+            optimizer.state[param] = {"exp_avg": torch.zeros_like(param),
+                                      "exp_avg_sq": torch.zeros_like(param), "step": torch.tensor(1.0)}
+        torch.save({'epoch': 0, 'state_dict': model.state_dict(),
+                    'optimizer': optimizer.state_dict(), 'loss': 0}, checkpoint_path)
+    script_path = os.path.join(args.workdir, "bench-las-greedy.pt")
+    scripted = export_las(model, script_path)
+
+    eager_load = time_load(lambda: load_las(CONF, checkpoint_path).eval(), args.load_repeat)
+    script_load = time_load(lambda: torch.jit.load(script_path), args.load_repeat)
+    print("load: eager {:.3f}s, scripted {:.3f}s".format(eager_load, script_load))
+
+    utterances = load_utterances(args.data, args.nutterances, args.min_len, args.max_len, args.seed)
+    model = model.to("cpu")
+    eager, script = [], []
+    with torch.no_grad():
+        # warm up; the first scripted calls also run the profiling executor
+        for _ in range(3):
+            model.inference([utterances[0]], None, timestep=args.timestep)
+            scripted(utterances[0])
+        for utterance in utterances:
+            start = time.perf_counter()
+            model.inference([utterance], None, timestep=args.timestep)
+            eager.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            scripted(utterance)
+            script.append(time.perf_counter() - start)
+    print("per utterance: eager p50 {:.1f}ms p90 {:.1f}ms, scripted p50 {:.1f}ms p90 {:.1f}ms, speedup {:.2f}x".format(
+        1000 * np.percentile(eager, 50), 1000 * np.percentile(eager, 90),
+        1000 * np.percentile(script, 50), 1000 * np.percentile(script, 90),
+        np.sum(eager) / np.sum(script)))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="TorchScript vs eager LAS latency at batch size 1")
+    parser.add_argument('--weights', type=str, default=None,
+                        help='training checkpoint (default: random weights)')
+    parser.add_argument('--data', type=str, default=None,
+                        help='utterance .npy file (default: synthetic utterances)')
+    parser.add_argument('--workdir', type=str, default="/tmp",
+                        help='where temporary artifacts are written')
+    parser.add_argument('--nutterances', type=int, default=20)
+    parser.add_argument('--min-len', type=int, default=200)
+    parser.add_argument('--max-len', type=int, default=1200)
+    parser.add_argument('--timestep', type=int, default=None,
+                        help='hard cap on decoded characters for the eager model')
+    parser.add_argument('--load-repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
@@ -0,0 +1,109 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import numpy as np
+import torch
+from torch.nn.utils import rnn
+
+from benchmark import synthetic_batch
+from config import MODEL_CONFIG as CONF
+from model import Listener, DEVICE
+
+def padded_forward(listener, inputs_list):
+    """
+    Reference Listener.forward that unpacks, reshapes and repacks between
+    layers, kept to check pyramid_reduce against.
+    """
+    inputs_length = torch.LongTensor([len(utterance) for utterance in inputs_list])
+    outputs_length = inputs_length // (2 ** (listener.nlayers - 1))
+    packed_inputs = rnn.pack_sequence(inputs_list).to(DEVICE)
+    for i in range(listener.nlayers):
+        lstm_outputs, _ = listener.lstm_list[i](packed_inputs)
+        unpacked_outputs, _ = rnn.pad_packed_sequence(lstm_outputs)
+        if i != listener.nlayers - 1:
+            longest_len = unpacked_outputs.shape[0]
+            dim = unpacked_outputs.shape[2]
+            unpacked_outputs = unpacked_outputs.permute(1, 0, 2)
+            if longest_len % 2 != 0:
+                unpacked_outputs = unpacked_outputs[:,0:-1,...]
+            longest_len = longest_len // 2
+            dim = dim * 2
+            unpacked_outputs = unpacked_outputs.contiguous().view(-1, longest_len, dim)
+            unpacked_outputs = unpacked_outputs.permute(1, 0, 2)
+            lengths = inputs_length // (2 ** (i+1))
+            packed_inputs = rnn.pack_padded_sequence(unpacked_outputs, lengths)
+    return unpacked_outputs.transpose(0, 1), outputs_length
+
+def make_inputs(args):
+    rng = np.random.RandomState(args.seed)
+    inputs, _ = synthetic_batch(rng, args.batch_size, args.frames_mean, args.frames_std, 0)
+    return inputs
+
+def make_listener(args):
+    torch.manual_seed(args.seed)
+    return Listener(CONF["input_size"], CONF["listener_hidden_size"], CONF["nlayers"]).to(DEVICE)
+
+def run(listener, inputs, variant, backward):
+    if variant == "padded":
+        outputs, _ = padded_forward(listener, inputs)
+    else:
+        outputs, _ = listener(inputs)
+    if backward:
+        outputs.sum().backward()
+    return outputs
+
+def peak_memory(args, variant, result_queue):
+    """
+    Runs in a fresh process; reports how far the peak RSS rose during one step.
+    """
+    listener = make_listener(args)
+    inputs = make_inputs(args)
+    # warm up kernels and the allocator on a short batch
+    run(listener, [u[:64] for u in inputs], variant, args.backward)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run(listener, inputs, variant, args.backward)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_queue.put((after - before) / 1024.0)
+
+def main(args):
+    listener = make_listener(args)
+    inputs = make_inputs(args)
+    with torch.no_grad():
+        reference, reference_length = padded_forward(listener, inputs)
+        outputs, outputs_length = listener(inputs)
+    identical = torch.equal(reference, outputs) and torch.equal(reference_length, outputs_length)
+    print("{} utterances of {}-{} frames, outputs identical: {}".format(
+        len(inputs), len(inputs[-1]), len(inputs[0]), identical))
+
+    for variant in ("padded", "packed"):
+        times = []
+        for _ in range(args.repeat):
+            listener.zero_grad()
+            start = time.perf_counter()
+            with torch.set_grad_enabled(args.backward):
+                run(listener, inputs, variant, args.backward)
+            times.append(time.perf_counter() - start)
+        context = multiprocessing.get_context("spawn")
+        result_queue = context.Queue()
+        process = context.Process(target=peak_memory, args=(args, variant, result_queue))
+        process.start()
+        peak = result_queue.get()
+        process.join()
+        print("{:>7}: median {:8.1f}ms, best {:8.1f}ms, peak RSS growth {:8.1f} MB".format(
+            variant, 1000 * np.median(times), 1000 * np.min(times), peak))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="pyramid BLSTM: packed vs pad/pack round trips")
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"])
+    parser.add_argument('--frames-mean', type=float, default=2000)
+    parser.add_argument('--frames-std', type=float, default=300)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backward', action='store_true',
+                        help='time forward + backward instead of inference')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
@@ -0,0 +1,84 @@
+import argparse
+import time
+import torch
+from torch.utils.data import DataLoader
+
+from bench_decoding import load_utterances, batches
+from benchmark import cpu_only
+from config import PRESETS
+from evaluate import evaluate, eval_subset
+from model import load_las
+from myDataset import open_dataset, collate_seq
+
+FRAME_SECONDS = 0.01
+
+def parameter_count(model):
+    return sum(p.numel() for p in model.parameters())
+
+def decode_time(model, utterances, batch_size, beam_width):
+    start = time.perf_counter()
+    with torch.no_grad():
+        for inputs in batches(utterances, batch_size):
+            model.inference(inputs, None, beam_width=beam_width)
+    return time.perf_counter() - start
+
+def main(args):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    utterances = load_utterances(args.data, args.nutterances, args.min_len, args.max_len, args.seed)
+    audio_seconds = FRAME_SECONDS * sum(len(u) for u in utterances)
+    weights = args.weights if args.weights is not None else [None] * len(args.presets)
+    assert len(weights) == len(args.presets), "one checkpoint per preset"
+    dev_loader = None
+    if args.dev_data is not None:
+        dev_set = open_dataset(args.dev_data, args.dev_transcripts, args.mmap)
+        dev_loader = DataLoader(eval_subset(dev_set, args.dev_utterances), shuffle=False,
+                                batch_size=args.batch_size, collate_fn=collate_seq)
+
+    print("{} utterances, {:.1f}s of audio, {} threads".format(len(utterances), audio_seconds, args.threads))
+    for name, weights_path in zip(args.presets, weights):
+        model = load_las(PRESETS[name], weights_path).eval()
+        # warm up so that allocator and thread pool start-up is not timed
+        decode_time(model, utterances[:args.batch_size], args.batch_size, 1)
+        elapsed = decode_time(model, utterances, args.batch_size, args.beam_width)
+        rtf = elapsed / audio_seconds
+        line = "{:>6}: {:6.2f}M parameters, decode {:6.2f}s, RTF {:.3f}{}".format(
+            name, parameter_count(model) / 1e6, elapsed, rtf,
+            " (over budget)" if args.rtf_budget > 0 and rtf > args.rtf_budget else "")
+        if dev_loader is not None and weights_path is not None:
+            cer, wer, nutterances, _ = evaluate(model, dev_loader, beam_width=args.beam_width)
+            line += ", dev CER {:.4f} WER {:.4f} ({} utterances)".format(cer, wer, nutterances)
+        print(line)
+
+def arguments():
+    parser = argparse.ArgumentParser(description="size, CPU real-time factor and dev CER of the model presets")
+    parser.add_argument('--presets', type=str, nargs='+', default=sorted(PRESETS),
+                        choices=sorted(PRESETS))
+    parser.add_argument('--weights', type=str, nargs='+', default=None,
+                        help='one trained checkpoint per preset, for dev CER')
+    parser.add_argument('--data', type=str, default=None,
+                        help='utterance .npy file to time (default: synthetic utterances)')
+    parser.add_argument('--nutterances', type=int, default=32)
+    parser.add_argument('--min-len', type=int, default=500,
+                        help='shortest synthetic utterance in frames')
+    parser.add_argument('--max-len', type=int, default=1000,
+                        help='longest synthetic utterance in frames')
+    parser.add_argument('--dev-data', type=str, default=None)
+    parser.add_argument('--dev-transcripts', type=str, default="./data/dev_char.npy")
+    parser.add_argument('--mmap', action='store_true',
+                        help='dev paths are featstore.py prefixes')
+    parser.add_argument('--dev-utterances', type=int, default=200,
+                        help='dev subset size (0: all)')
+    parser.add_argument('--batch-size', type=int, default=PRESETS["base"]["batch_size"])
+    parser.add_argument('--beam-width', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=1,
+                        help='torch CPU threads, e.g. 1 for a single-core device')
+    parser.add_argument('--rtf-budget', type=float, default=0,
+                        help='flag presets slower than this real-time factor (0: off)')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    cpu_only()
+    main(args)
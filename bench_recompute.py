@@ -0,0 +1,90 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+from benchmark import cpu_only, synthetic_batch
+from config import MODEL_CONFIG as CONF
+from model import LAS, sequence_loss
+
+VARIANTS = ("none", "listener", "speller", "both")
+
+def make_model(args, variant):
+    torch.manual_seed(args.seed)
+    model = LAS(CONF["input_size"], CONF["listener_hidden_size"], CONF["nlayers"],
+                CONF["speller_hidden_dim"], CONF["embedding_dim"],
+                CONF["class_size"], CONF["key_dim"], CONF["value_dim"], CONF["batch_size"],
+                recompute_listener=variant in ("listener", "both"),
+                recompute_segment=args.segment if variant in ("speller", "both") else 0)
+    return model.train()
+
+def make_batch(args):
+    rng = np.random.RandomState(args.seed)
+    return synthetic_batch(rng, args.batch_size, args.frames_mean, args.frames_std, args.chars_per_frame)
+
+def train_step(model, criterion, inputs, targets):
+    model.zero_grad()
+    probs, _, targets_for_loss, targets_length_for_loss, _ = model(inputs, targets, teacher_forcing=0.2)
+    loss, _ = sequence_loss(probs, targets_for_loss, targets_length_for_loss, criterion)
+    loss.backward()
+
+def peak_memory(args, variant, result_queue):
+    """
+    Runs in a fresh process; reports how far the peak RSS rose during one
+    training step.
+    """
+    model = make_model(args, variant)
+    inputs, targets = make_batch(args)
+    criterion = nn.CrossEntropyLoss(reduction="sum")
+    # warm up kernels and the allocator on a short batch
+    train_step(model, criterion, [u[:64] for u in inputs], [t[:8] for t in targets])
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    train_step(model, criterion, inputs, targets)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_queue.put((after - before) / 1024.0)
+
+def main(args):
+    inputs, targets = make_batch(args)
+    criterion = nn.CrossEntropyLoss(reduction="sum")
+    print("{} utterances, {} frames, {} target chars, speller segment {}".format(
+        len(inputs), sum(len(u) for u in inputs), sum(len(t) - 1 for t in targets), args.segment))
+    baseline = None
+    for variant in VARIANTS:
+        model = make_model(args, variant)
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            train_step(model, criterion, inputs, targets)
+            times.append(time.perf_counter() - start)
+        context = multiprocessing.get_context("spawn")
+        result_queue = context.Queue()
+        process = context.Process(target=peak_memory, args=(args, variant, result_queue))
+        process.start()
+        peak = result_queue.get()
+        process.join()
+        step_time = np.median(times)
+        if baseline is None:
+            baseline = (step_time, peak)
+        print("{:>8}: step {:8.1f}ms ({:+6.1f}%), peak RSS growth {:8.1f} MB ({:+6.1f}%)".format(
+            variant, 1000 * step_time, 100 * (step_time / baseline[0] - 1),
+            peak, 100 * (peak / max(baseline[1], 1e-6) - 1)))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="activation recomputation: peak memory vs step time")
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"])
+    parser.add_argument('--frames-mean', type=float, default=1500)
+    parser.add_argument('--frames-std', type=float, default=300)
+    parser.add_argument('--chars-per-frame', type=float, default=0.15)
+    parser.add_argument('--segment', type=int, default=16,
+                        help='Speller steps per recomputed segment')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    cpu_only()
+    main(args)
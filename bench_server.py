@@ -0,0 +1,105 @@
+import argparse
+import io
+import json
+import threading
+import time
+import urllib.request
+import numpy as np
+import torch
+
+from bench_decoding import build_model, load_utterances
+from server import serve
+
+def post(url, features):
+    buffer = io.BytesIO()
+    np.save(buffer, features)
+    request = urllib.request.Request(url + "/transcribe", data=buffer.getvalue(),
+                                     headers={"Content-Type": "application/octet-stream"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())["text"]
+
+def get_metrics(url):
+    with urllib.request.urlopen(url + "/metrics") as response:
+        return json.loads(response.read())
+
+def generate_load(url, utterances, nclients, nrequests):
+    """
+    nclients closed-loop clients send nrequests in total.
+    return: (per-request latencies, wall time)
+    """
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(nrequests))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            post(url, utterances[i % len(utterances)])
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(nclients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return np.array(latencies), time.perf_counter() - start
+
+def report(name, latencies, wall, metrics):
+    print("{:>10}: p50 {:7.1f}ms, p99 {:7.1f}ms, {:7.2f} req/s, mean batch {:5.2f}, max queue {}".format(
+        name, 1000 * np.percentile(latencies, 50), 1000 * np.percentile(latencies, 99),
+        len(latencies) / wall, metrics["mean_batch_size"], metrics["max_queue_depth"]))
+
+def main(args):
+    utterances = [u.numpy() for u in load_utterances(args.data, args.nutterances,
+                                                         args.min_len, args.max_len, args.seed)]
+    print("{} clients, {} requests".format(args.clients, args.requests))
+    if args.url is not None:
+        latencies, wall = generate_load(args.url, utterances, args.clients, args.requests)
+        report("remote", latencies, wall, get_metrics(args.url))
+        return
+    torch.manual_seed(args.seed)
+    model = build_model(args.weights)
+    for window in args.windows:
+        server, batcher = serve(model, "127.0.0.1", 0, args.max_batch, window / 1000.0,
+                                {"timestep": args.timestep})
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        # warm up
+        post(url, utterances[0])
+        latencies, wall = generate_load(url, utterances, args.clients, args.requests)
+        report("{}ms".format(window), latencies, wall, get_metrics(url))
+        server.shutdown()
+        server.server_close()
+        batcher.stop()
+
+def arguments():
+    parser = argparse.ArgumentParser(description="load generator for server.py")
+    parser.add_argument('--url', type=str, default=None,
+                        help='running server to load (default: start one per batch window)')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='checkpoint for the in-process server (default: random weights)')
+    parser.add_argument('--data', type=str, default=None,
+                        help='utterance .npy file (default: synthetic utterances)')
+    parser.add_argument('--nutterances', type=int, default=32)
+    parser.add_argument('--min-len', type=int, default=200)
+    parser.add_argument('--max-len', type=int, default=1200)
+    parser.add_argument('--clients', type=int, default=16,
+                        help='concurrent closed-loop clients')
+    parser.add_argument('--requests', type=int, default=128)
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 5, 20, 50],
+                        help='batch windows (max wait in ms) to compare')
+    parser.add_argument('--max-batch', type=int, default=16)
+    parser.add_argument('--timestep', type=int, default=None,
+                        help='hard cap on decoded characters')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
@@ -0,0 +1,103 @@
+import argparse
+import time
+import numpy as np
+import torch
+
+from bench_decoding import build_model, load_utterances
+from streaming import StreamingRecognizer
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+def simulate_stream(recognizer, utterance, feed_frames, frame_shift):
+    """
+    Feed the utterance in feed_frames pieces as if it arrived live.
+    Time is simulated: a piece becomes available at its audio end time, and
+    processing starts at the later of that and the end of the previous piece.
+    return: (first token latency from utterance start, compute seconds, tokens)
+    """
+    recognizer.reset()
+    clock = 0.0
+    compute = 0.0
+    first_token = None
+    tokens = []
+    for start in range(0, len(utterance), feed_frames):
+        chunk = utterance[start:start + feed_frames]
+        clock = max(clock, (start + len(chunk)) * frame_shift)
+        begin = time.perf_counter()
+        new_tokens = recognizer.accept(chunk)
+        elapsed = time.perf_counter() - begin
+        clock += elapsed
+        compute += elapsed
+        if first_token is None and len(new_tokens) > 0:
+            first_token = clock
+        tokens += new_tokens
+    begin = time.perf_counter()
+    new_tokens = recognizer.flush()
+    elapsed = time.perf_counter() - begin
+    clock += elapsed
+    compute += elapsed
+    if first_token is None and len(new_tokens) > 0:
+        first_token = clock
+    tokens += new_tokens
+    return first_token, compute, tokens
+
+def time_offline(model, utterance, frame_shift):
+    begin = time.perf_counter()
+    prediction = model.inference([utterance], None)[0]
+    elapsed = time.perf_counter() - begin
+    # nothing is emitted before the whole utterance has arrived
+    return len(utterance) * frame_shift + elapsed, elapsed, prediction
+
+def main(args):
+    torch.manual_seed(args.seed)
+    model = build_model(args.weights)
+    utterances = load_utterances(args.data, args.nutterances, args.min_len, args.max_len, args.seed)
+    recognizer = StreamingRecognizer(model, args.chunk_frames, args.left_context, args.lookahead,
+                                     args.decoder_lookahead)
+    audio = sum(len(u) for u in utterances) * args.frame_shift
+    stream_first, stream_compute, offline_first, offline_compute = [], 0.0, [], 0.0
+    with torch.no_grad():
+        # warm up
+        model.inference([utterances[0]], None)
+        for utterance in utterances:
+            first, compute, _ = simulate_stream(recognizer, utterance, args.feed_frames, args.frame_shift)
+            if first is not None:
+                stream_first.append(first)
+            stream_compute += compute
+            first, compute, _ = time_offline(model, utterance, args.frame_shift)
+            offline_first.append(first)
+            offline_compute += compute
+
+    print("{} utterances, {:.1f}s of audio, device {}".format(len(utterances), audio, DEVICE))
+    if len(stream_first) > 0:
+        print("streaming: first token p50 {:.3f}s, p90 {:.3f}s, real-time factor {:.3f}".format(
+            np.percentile(stream_first, 50), np.percentile(stream_first, 90), stream_compute / audio))
+    else:
+        print("streaming: no tokens emitted, real-time factor {:.3f}".format(stream_compute / audio))
+    print("offline:   first token p50 {:.3f}s, p90 {:.3f}s, real-time factor {:.3f}".format(
+        np.percentile(offline_first, 50), np.percentile(offline_first, 90), offline_compute / audio))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="LAS streaming latency benchmark")
+    parser.add_argument('--weights', type=str, default=None,
+                        help='checkpoint to load (default: random weights)')
+    parser.add_argument('--data', type=str, default=None,
+                        help='utterance .npy file (default: synthetic utterances)')
+    parser.add_argument('--nutterances', type=int, default=8)
+    parser.add_argument('--min-len', type=int, default=400)
+    parser.add_argument('--max-len', type=int, default=1600)
+    parser.add_argument('--feed-frames', type=int, default=16,
+                        help='frames delivered per call, e.g. 16 = 160ms of audio')
+    parser.add_argument('--frame-shift', type=float, default=0.01,
+                        help='seconds of audio per input frame')
+    parser.add_argument('--chunk-frames', type=int, default=64)
+    parser.add_argument('--left-context', type=int, default=64)
+    parser.add_argument('--lookahead', type=int, default=32)
+    parser.add_argument('--decoder-lookahead', type=int, default=2,
+                        help='encoder frames the attention peak must stay behind the newest frame')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+import model as las_model
+from config import MODEL_CONFIG as CONF
+from model import load_las, sequence_loss
+from myDataset import collate_seq
+from vocab import LABEL_MAP
+
+def cpu_only():
+    """
+    Benchmarks run on the CPU so numbers are comparable across machines and
+    runs. Call before building a model: this points model.DEVICE at the CPU
+    and hides CUDA devices from the processes started afterwards.
+    """
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    las_model.DEVICE = "cpu"
+
+def synthetic_batch(rng, batch_size, frames_mean, frames_std, chars_per_frame, min_frames=64):
+    """
+    Random utterances (n_frames * input_size) with normally distributed lengths and
+    random transcripts of about chars_per_frame * n_frames characters
+    wrapped in <sos>/<eos>, sorted longest first as collate_seq does.
+    """
+    lengths = np.maximum(rng.normal(frames_mean, frames_std, size=batch_size).astype(int), min_frames)
+    inputs, targets = [], []
+    for n in sorted(lengths, reverse=True):
+        inputs.append(torch.tensor(rng.randn(n, CONF["input_size"]).astype(np.float32)))
+        nchars = max(int(n * chars_per_frame), 1)
+        chars = rng.randint(LABEL_MAP['<space>'], CONF["class_size"], size=nchars)
+        targets.append(torch.tensor(np.concatenate(([LABEL_MAP['<sos>']], chars, [LABEL_MAP['<eos>']]))))
+    return inputs, targets
+
+def frontend_config(spec):
+    """
+    "2" -> CONF stacking 2 frames, "2:128" -> stacking 2 frames projected to 128
+    """
+    parts = spec.split(":")
+    conf = dict(CONF)
+    conf["frame_stack"] = int(parts[0])
+    conf["frontend_dim"] = int(parts[1]) if len(parts) > 1 else 0
+    return conf
+
+def measure(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), float(np.min(times))
+
+def run_suite(args):
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    model = load_las(CONF)
+    inputs, targets = synthetic_batch(rng, args.batch_size, args.frames_mean, args.frames_std,
+                                      args.chars_per_frame)
+    nframes = sum(len(u) for u in inputs)
+    nchars = sum(len(t) - 1 for t in targets)
+    criterion = nn.CrossEntropyLoss(reduction="sum")
+    speller = model.speller
+
+    with torch.no_grad():
+        listener_output, outputs_length = model.listener(inputs)
+        state = speller.initial_state(len(inputs))
+        key, value, attention_mask = speller.attention.project(listener_output, outputs_length)
+        context, _ = speller.attention.attend(state[2], key, value, attention_mask)
+        embed = speller.embed(torch.full((len(inputs),), LABEL_MAP['<sos>'], dtype=torch.long))
+        probs, _, targets_for_loss, targets_length_for_loss, _ = model(inputs, targets, teacher_forcing=1.0)
+    probs = probs.detach().requires_grad_()
+    samples = list(zip(inputs, targets))
+
+    def forward_backward(model):
+        def step():
+            model.zero_grad()
+            probs, _, targets_for_loss, targets_length_for_loss, _ = model(inputs, targets, teacher_forcing=0.9)
+            loss, _ = sequence_loss(probs, targets_for_loss, targets_length_for_loss, criterion)
+            loss.backward()
+        return step
+
+    def loss_backward():
+        probs.grad = None
+        loss, _ = sequence_loss(probs, targets_for_loss, targets_length_for_loss, criterion)
+        loss.backward()
+
+    def no_grad(fn):
+        def wrapped():
+            with torch.no_grad():
+                fn()
+        return wrapped
+
+    # name: (callable, frames processed, characters processed)
+    components = {
+        "listener_forward": (no_grad(lambda: model.listener(inputs)), nframes, 0),
+        "attention_forward": (no_grad(lambda: speller.attention(state[2], listener_output, outputs_length)),
+                              nframes, len(inputs)),
+        "speller_step": (no_grad(lambda: speller.step(embed, context, state, key, value, attention_mask)),
+                         0, len(inputs)),
+        "las_forward_backward": (forward_backward(model), nframes, nchars),
+        "las_inference": (no_grad(lambda: model.inference(inputs, None, timestep=args.decode_steps)),
+                          nframes, 0),
+        "collate_seq": (lambda: collate_seq(samples), nframes, nchars),
+        "loss_forward_backward": (loss_backward, 0, nchars),
+    }
+    # the same training step and decoding with a frame stacking front end
+    for spec in args.frontends:
+        frontend_model = load_las(frontend_config(spec))
+        components["las_forward_backward_stack" + spec] = (forward_backward(frontend_model), nframes, nchars)
+        components["las_inference_stack" + spec] = (
+            no_grad(lambda m=frontend_model: m.inference(inputs, None, timestep=args.decode_steps)), nframes, 0)
+    results = {}
+    for name, (fn, frames, chars) in components.items():
+        if args.only and name not in args.only:
+            continue
+        median, best = measure(fn, args.repeat, args.warmup)
+        results[name] = {
+            "seconds": median,
+            "best_seconds": best,
+            "frames_per_sec": frames / median if frames > 0 else None,
+            "chars_per_sec": chars / median if chars > 0 else None,
+        }
+        print("{:>32}: {:9.3f} ms  {:>12}  {:>12}".format(
+            name, 1000 * median,
+            "{:.0f} fr/s".format(frames / median) if frames > 0 else "",
+            "{:.0f} ch/s".format(chars / median) if chars > 0 else ""))
+    return {
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("output", "baseline", "save_baseline", "threshold")},
+        "model": CONF,
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "threads": torch.get_num_threads(),
+        "results": results,
+    }
+
+def compare(report, baseline, threshold):
+    """
+    Components are compared on their fastest repetition, which is less
+    sensitive to scheduling noise than the median.
+    return: list of (name, baseline seconds, current seconds) slower than
+            baseline * (1 + threshold)
+    """
+    regressions = []
+    for name, result in report["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["best_seconds"]
+        after = result["best_seconds"]
+        change = after / before - 1
+        flag = "REGRESSION" if change > threshold else ""
+        print("{:>32}: {:9.3f} ms -> {:9.3f} ms ({:+6.1f}%) {}".format(
+            name, 1000 * before, 1000 * after, 100 * change, flag))
+        if change > threshold:
+            regressions.append((name, before, after))
+    return regressions
+
+def arguments():
+    parser = argparse.ArgumentParser(description="LAS component benchmarks (CPU)")
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"])
+    parser.add_argument('--frames-mean', type=float, default=800,
+                        help='mean utterance length in frames')
+    parser.add_argument('--frames-std', type=float, default=200)
+    parser.add_argument('--chars-per-frame', type=float, default=0.1,
+                        help='transcript length relative to utterance length')
+    parser.add_argument('--decode-steps', type=int, default=100,
+                        help='cap on characters decoded by las_inference')
+    parser.add_argument('--frontends', type=str, nargs='+', default=[],
+                        help='also time las_forward_backward and las_inference with these '
+                             'frame_stack[:frontend_dim] front ends, e.g. 2 3 2:128')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch intra-op threads (default: torch default)')
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                        help='run only these components')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default="benchmark.json",
+                        help='where to write the results')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed slowdown before a component is flagged')
+    parser.add_argument('--save-baseline', type=str, default=None,
+                        help='also store these results as a baseline file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    cpu_only()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    report = run_suite(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if len(regressions) > 0:
+            print("{} component(s) regressed by more than {:.0f}%".format(
+                len(regressions), 100 * args.threshold))
+            sys.exit(1)
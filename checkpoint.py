@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+def snapshot(obj):
+    """
+    Copy every tensor of a (nested) state dict to the CPU so training can keep
+    updating the live tensors while the copy is written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+def atomic_save(obj, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class CheckpointManager(object):
+    """
+    Writes training checkpoints on a background thread. save() only snapshots
+    model and optimizer state to the CPU; serialization, the atomic rename and
+    rotation happen off the training loop. The last keep_last checkpoints and
+    the one with the lowest loss are kept and listed in <save_dir>/manifest.json.
+    "latest" is the newest checkpoint still on disk, so with keep_last 0, where
+    only the best one is kept, resuming "latest" resumes the best. The loss
+    should be comparable across batches; train.py passes the loss per target
+    token.
+    Checkpoints use the same keys as before ('epoch' is the epoch to resume at,
+    'state_dict', 'optimizer', 'loss'), so older files load through load();
+    with config given it is stored as well, for model.load_las.
+    """
+    def __init__(self, save_dir, keep_last=3, asynchronous=True, config=None):
+        self.save_dir = save_dir
+        self.config = config
+        self.keep_last = keep_last
+        self.manifest_path = os.path.join(save_dir, "manifest.json")
+        os.makedirs(save_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.manifest = self.read_manifest()
+        self.executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self.pending = []
+
+    def read_manifest(self):
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {"checkpoints": [], "best": None, "latest": None}
+
+    def write_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def save(self, epoch, step, model, optimizer, loss):
+        self.check_pending()
+        loss = float(loss)
+        state = {
+            'epoch': epoch + 1,
+            'step': step,
+            'state_dict': snapshot(model.state_dict()),
+            'optimizer': snapshot(optimizer.state_dict()),
+            'loss': loss
+        }
+        if self.config is not None:
+            state['config'] = self.config
+        filename = "{}-{}.pth".format(epoch, step)
+        print('Save model at Train Epoch: {} [Step: {}\tLoss: {:.12f}]'.format(epoch, step, loss))
+        if self.executor is None:
+            self.write(state, filename)
+        else:
+            self.pending.append(self.executor.submit(self.write, state, filename))
+
+    def write(self, state, filename):
+        atomic_save(state, os.path.join(self.save_dir, filename))
+        entry = {"file": filename, "epoch": state['epoch'] - 1, "step": state['step'],
+                 "loss": state['loss'], "time": time.time()}
+        with self.lock:
+            checkpoints = [c for c in self.manifest["checkpoints"] if c["file"] != filename]
+            checkpoints.append(entry)
+            best = min(checkpoints, key=lambda c: c["loss"])
+            # checkpoints[-0:] would be all of them
+            recent = checkpoints[-self.keep_last:] if self.keep_last > 0 else []
+            keep = set(c["file"] for c in recent) | {best["file"]}
+            for c in checkpoints:
+                if c["file"] not in keep and os.path.isfile(os.path.join(self.save_dir, c["file"])):
+                    os.remove(os.path.join(self.save_dir, c["file"]))
+            kept = [c for c in checkpoints if c["file"] in keep]
+            self.manifest = {
+                "checkpoints": kept,
+                "best": best["file"],
+                "latest": kept[-1]["file"],
+            }
+            self.write_manifest()
+
+    def check_pending(self):
+        # surface errors of finished background writes
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        for future in done:
+            future.result()
+
+    def wait(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def resolve(self, name):
+        """
+        name: "latest", "best" or a checkpoint path
+        """
+        if name in ("latest", "best"):
+            filename = self.manifest[name]
+            if filename is None:
+                return None
+            return os.path.join(self.save_dir, filename)
+        return name
+
+    def load(self, name, model, optimizer=None):
+        """
+        return: (start_epoch, loss), or None when there is nothing to resume from
+        """
+        path = self.resolve(name)
+        if path is None or not os.path.isfile(path):
+            print("no such checkpoint: ", name)
+            return None
+        print("######### loading weights ##########")
+        checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+        model.load_state_dict(checkpoint['state_dict'])
+        if optimizer is not None and 'optimizer' in checkpoint:
+            optimizer.load_state_dict(checkpoint['optimizer'])
+        print('########## loading weights done ##########')
+        return checkpoint['epoch'], float(checkpoint['loss'])
+
+def save_weights(model, conf, path):
+    """
+    Weights-only inference artifact: no optimizer state, readable by model.load_las.
+    """
+    atomic_save({'config': conf, 'state_dict': snapshot(model.state_dict())}, path)
@@ -7,5 +7,28 @@ MODEL_CONFIG = {
     "class_size": 34,
     "key_dim": 128,
     "value_dim": 128,
-    "batch_size": 20
+    "batch_size": 20,
+    # front end: stack and subsample every frame_stack input frames, optionally
+    # projected to frontend_dim (0: no projection); see model.Listener
+    "frame_stack": 1,
+    "frontend_dim": 0
+}
+
+# named model sizes; "base" is MODEL_CONFIG, the others are students for
+# distillation from a base teacher (train.py --preset, --teacher)
+PRESETS = {
+    "base": MODEL_CONFIG,
+    "small": dict(MODEL_CONFIG,
+                  listener_hidden_size=128,
+                  speller_hidden_dim=256,
+                  embedding_dim=128,
+                  key_dim=64,
+                  value_dim=64),
+    "tiny": dict(MODEL_CONFIG,
+                 listener_hidden_size=96,
+                 speller_hidden_dim=192,
+                 embedding_dim=64,
+                 key_dim=64,
+                 value_dim=64,
+                 frame_stack=2),
 }
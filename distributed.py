@@ -0,0 +1,42 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+def launch(worker, world_size, args, master_port=29500):
+    """
+    Run worker(rank, world_size, *args) in world_size processes on this
+    machine, or in the current process when world_size is 1.
+    """
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(master_port))
+    if world_size == 1:
+        worker(0, world_size, *args)
+    else:
+        mp.spawn(worker, args=(world_size,) + tuple(args), nprocs=world_size, join=True)
+
+def init_worker(rank, world_size, threads=None):
+    """
+    Join the gloo process group and split the cores between the processes so
+    N workers do not each start a full-size intra-op thread pool.
+    """
+    if threads is None and world_size > 1:
+        threads = max((os.cpu_count() or 1) // world_size, 1)
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if world_size > 1:
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+def unwrap(model):
+    """
+    The LAS inside a DistributedDataParallel wrapper, for checkpoints,
+    hooks and inference.
+    """
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
@@ -0,0 +1,179 @@
+import argparse
+import collections
+import hashlib
+import os
+import time
+import numpy as np
+import torch
+
+from config import MODEL_CONFIG as CONF
+from metrics import error_rates
+from model import load_las, DEVICE
+from myDataset import open_dataset
+
+def encoder_digest(model, namespace=""):
+    """
+    sha1 of the Listener weights and a namespace (e.g. the data path), so a
+    cache entry is only reused for the same encoder on the same utterances.
+    Speller-only changes keep the cache valid.
+    """
+    digest = hashlib.sha1(namespace.encode())
+    for name, tensor in sorted(model.listener.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().to("cpu").contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+class EncoderCache(object):
+    """
+    On-disk cache of Listener outputs, one <cache_dir>/<digest>/<index>.npy
+    per utterance holding its outputs_length * listener_output_dim frames.
+    Hits are read through np.load(mmap_mode="r"); only misses run the
+    Listener. When the files under cache_dir exceed max_bytes the least
+    recently used ones are removed, whatever digest they belong to.
+    """
+    def __init__(self, cache_dir, model, namespace="", max_bytes=2 ** 30, dtype=np.float32):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.cache_dir = cache_dir
+        self.entry_dir = os.path.join(cache_dir, encoder_digest(model, namespace))
+        os.makedirs(self.entry_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        # path -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        files = []
+        for root, _, names in os.walk(cache_dir):
+            for name in names:
+                if name.endswith(".npy"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self.entries[path] = size
+        self.total_bytes = sum(self.entries.values())
+
+    def path(self, index):
+        return os.path.join(self.entry_dir, "{}.npy".format(index))
+
+    def get(self, index):
+        path = self.path(index)
+        if path not in self.entries:
+            return None
+        self.entries.move_to_end(path)
+        # mtime records use across processes for eviction order
+        os.utime(path)
+        return np.load(path, mmap_mode="r")
+
+    def put(self, index, output):
+        path = self.path(index)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, output.astype(self.dtype))
+        os.replace(tmp_path, path)
+        self.total_bytes += os.path.getsize(path) - self.entries.pop(path, 0)
+        self.entries[path] = os.path.getsize(path)
+        self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def encode(self, indices, inputs):
+        """
+        indices: dataset index of every utterance of the batch
+        inputs: utterances sorted longest first, as for Listener.forward
+        return: listener_output (batch_size * longest_len * dim on DEVICE),
+                outputs_length (1d LongTensor), as returned by Listener.forward
+        """
+        outputs = [self.get(index) for index in indices]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        self.misses += len(missing)
+        self.hits += len(indices) - len(missing)
+        if len(missing) > 0:
+            # a subsequence of a sorted batch is still sorted
+            with torch.no_grad():
+                listener_output, outputs_length = self.model.listener([inputs[i] for i in missing])
+            listener_output = listener_output.float().cpu().numpy()
+            for row, i in enumerate(missing):
+                outputs[i] = listener_output[row, :int(outputs_length[row])]
+                self.put(indices[i], outputs[i])
+        outputs_length = torch.LongTensor([len(output) for output in outputs])
+        padded = np.zeros((len(outputs), int(outputs_length.max()), outputs[0].shape[1]), dtype=np.float32)
+        for i, output in enumerate(outputs):
+            padded[i, :len(output)] = output
+        return torch.from_numpy(padded).to(DEVICE), outputs_length
+
+def sorted_batches(dataset, nutterances, batch_size):
+    """
+    yield: (indices, inputs, targets) with each batch sorted longest first
+    """
+    n = min(nutterances, len(dataset))
+    for start in range(0, n, batch_size):
+        indices = list(range(start, min(start + batch_size, n)))
+        items = [dataset[i] for i in indices]
+        order = sorted(range(len(items)), key=lambda i: len(items[i][0]), reverse=True)
+        yield ([indices[i] for i in order], [items[i][0] for i in order], [items[i][1] for i in order])
+
+def cached_decode(model, cache, dataset, nutterances, batch_size, **decode_kwargs):
+    """
+    Decode the first nutterances of dataset with the Listener outputs served by
+    cache. decode_kwargs go to LAS.decode (timestep, max_len_ratio, beam_width,
+    length_penalty).
+    return: (hypotheses, references, encoder seconds, decoder seconds)
+    """
+    hyps, refs = [], []
+    encoder_time = decoder_time = 0.0
+    with torch.no_grad():
+        for indices, inputs, targets in sorted_batches(dataset, nutterances, batch_size):
+            start = time.perf_counter()
+            listener_output, outputs_length = cache.encode(indices, inputs)
+            middle = time.perf_counter()
+            prediction_list = model.decode(listener_output, outputs_length, **decode_kwargs)
+            decoder_time += time.perf_counter() - middle
+            encoder_time += middle - start
+            hyps += [p.tolist() for p in prediction_list]
+            # strip <sos> and <eos> from the references
+            refs += [t[1:-1].tolist() for t in targets]
+    return hyps, refs, encoder_time, decoder_time
+
+def main(args):
+    model = load_las(CONF, args.weights).eval()
+    dev_set = open_dataset(args.dev_data, args.dev_transcripts, args.mmap)
+    cache = EncoderCache(args.cache_dir, model, namespace=os.path.abspath(args.dev_data),
+                         max_bytes=int(args.max_cache_mb * 2 ** 20))
+    for beam_width in args.beam_widths:
+        for max_len_ratio in args.max_len_ratios:
+            hyps, refs, encoder_time, decoder_time = cached_decode(
+                model, cache, dev_set, args.nutterances, args.batch_size,
+                beam_width=beam_width, max_len_ratio=max_len_ratio, length_penalty=args.length_penalty)
+            cer, wer = error_rates(hyps, refs)
+            print("beam {:>2}, max_len_ratio {:.2f}: CER {:.4f}, WER {:.4f}, "
+                  "encoder {:.2f}s, decoder {:.2f}s".format(beam_width, max_len_ratio, cer, wer,
+                                                          encoder_time, decoder_time))
+    print("cache: {} hits, {} misses, {:.1f} MB".format(cache.hits, cache.misses, cache.total_bytes / 2 ** 20))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="decoding parameter sweep over cached Listener outputs")
+    parser.add_argument('--weights', type=str, required=True,
+                        help='training checkpoint or weights artifact')
+    parser.add_argument('--dev-data', type=str, default="./data/dev.npy")
+    parser.add_argument('--dev-transcripts', type=str, default="./data/dev_char.npy")
+    parser.add_argument('--mmap', action='store_true',
+                        help='dev paths are featstore.py prefixes')
+    parser.add_argument('--cache-dir', type=str, default="./cache/encoder")
+    parser.add_argument('--max-cache-mb', type=float, default=4096,
+                        help='size bound of the cache directory')
+    parser.add_argument('--nutterances', type=int, default=1106)
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"])
+    parser.add_argument('--beam-widths', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--max-len-ratios', type=float, nargs='+', default=[2.0])
+    parser.add_argument('--length-penalty', type=float, default=1.0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
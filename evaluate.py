@@ -0,0 +1,110 @@
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from config import MODEL_CONFIG as CONF
+from metrics import corpus_counts, counts_to_rates
+from model import load_las
+from myDataset import open_dataset, collate_seq
+
+def decode_dataset(model, loader, nutterances, **decode_kwargs):
+    """
+    return: (hypotheses, references, seconds spent in LAS.inference)
+    """
+    hyps, refs = [], []
+    elapsed = 0.0
+    with torch.no_grad():
+        for inputs, targets in loader:
+            start = time.perf_counter()
+            prediction_list = model.inference(inputs, None, **decode_kwargs)
+            elapsed += time.perf_counter() - start
+            hyps += [p.tolist() for p in prediction_list]
+            # strip <sos> and <eos> from the references
+            refs += [t[1:-1].tolist() for t in targets]
+            if len(hyps) >= nutterances:
+                break
+    return hyps, refs, elapsed
+
+def metrics_pool(workers):
+    """
+    Process pool for edit distances. Workers are spawned rather than forked
+    so they do not inherit the trainer's torch threads and memory.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def evaluate(model, loader, executor=None, **decode_kwargs):
+    """
+    Batched LAS.inference over loader. Each batch's edit distances are handed
+    to executor as soon as it is decoded, so scoring overlaps decoding.
+    return: (CER, WER, utterances, seconds)
+    """
+    start = time.perf_counter()
+    was_training = model.training
+    model.eval()
+    totals = np.zeros(4, dtype=np.int64)
+    futures = []
+    nutterances = 0
+    with torch.no_grad():
+        for inputs, targets in loader:
+            prediction_list = model.inference(inputs, None, **decode_kwargs)
+            hyps = [p.tolist() for p in prediction_list]
+            refs = [t[1:-1].tolist() for t in targets]
+            nutterances += len(hyps)
+            if executor is None:
+                totals += corpus_counts(hyps, refs)
+            else:
+                futures.append(executor.submit(corpus_counts, hyps, refs))
+    for future in futures:
+        totals += future.result()
+    model.train(was_training)
+    cer, wer = counts_to_rates(totals)
+    return cer, wer, nutterances, time.perf_counter() - start
+
+def eval_subset(dataset, nutterances, seed=0):
+    """
+    A fixed random subset of nutterances, the same every epoch so the numbers
+    are comparable; the whole dataset when nutterances is 0 or too large.
+    """
+    if nutterances <= 0 or nutterances >= len(dataset):
+        return dataset
+    rng = np.random.RandomState(seed)
+    return Subset(dataset, np.sort(rng.choice(len(dataset), nutterances, replace=False)).tolist())
+
+def main(args):
+    model = load_las(CONF, args.weights)
+    model.speller.attention_window = args.attention_window
+    dev_set = open_dataset(args.dev_data, args.dev_transcripts, args.mmap)
+    loader = DataLoader(eval_subset(dev_set, args.nutterances), shuffle=False,
+                        batch_size=args.batch_size, collate_fn=collate_seq)
+    with metrics_pool(args.workers) as executor:
+        cer, wer, nutterances, elapsed = evaluate(model, loader, executor,
+                                                  beam_width=args.beam_width,
+                                                  max_len_ratio=args.max_len_ratio)
+    print("{} utterances in {:.2f}s: CER {:.4f}, WER {:.4f}".format(nutterances, elapsed, cer, wer))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="CER/WER of a checkpoint on the dev set")
+    parser.add_argument('--weights', type=str, required=True,
+                        help='training checkpoint or weights artifact')
+    parser.add_argument('--dev-data', type=str, default="./data/dev.npy")
+    parser.add_argument('--dev-transcripts', type=str, default="./data/dev_char.npy")
+    parser.add_argument('--mmap', action='store_true',
+                        help='dev paths are featstore.py prefixes')
+    parser.add_argument('--nutterances', type=int, default=0,
+                        help='evaluate a fixed random subset (0: all)')
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"])
+    parser.add_argument('--beam-width', type=int, default=1)
+    parser.add_argument('--max-len-ratio', type=float, default=2.0)
+    parser.add_argument('--attention-window', type=int, default=0,
+                        help='windowed attention width in encoder frames (0: full attention)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='edit distance processes (default: cores)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
@@ -0,0 +1,123 @@
+import argparse
+import copy
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from config import MODEL_CONFIG as CONF
+from model import load_las
+from vocab import LABEL_MAP
+
+class ScriptableLAS(nn.Module):
+    """
+    TorchScript-compatible single-utterance encoder and greedy decoder that
+    shares the weights of a trained LAS. With one utterance there is no
+    padding, so the Listener runs on a plain seq_len * 1 * dim tensor instead
+    of packed sequences and the attention needs no mask. The decoding budget
+    matches Speller.inference: ceil(encoder_len * max_len_ratio) steps or <eos>.
+    """
+    def __init__(self, las, max_len_ratio=2.0):
+        super(ScriptableLAS, self).__init__()
+        speller = las.speller
+        self.lstm_list = las.listener.lstm_list
+        self.nlayers = las.listener.nlayers
+        self.frame_stack = las.listener.frame_stack
+        self.pyramid_reductions = las.listener.pyramid_reductions
+        self.frontend = las.listener.frontend
+        self.mlp_s = speller.attention.mlp_s
+        self.mlp_h = speller.attention.mlp_h
+        self.value_projection = speller.attention.value_projection
+        self.embed = speller.embed
+        self.rnn_layer1 = speller.rnn_layer1
+        self.rnn_layer2 = speller.rnn_layer2
+        self.char_distribution_linear = speller.char_distribution_linear
+        self.register_buffer("rnn1_h0", speller.rnn1_hidden_state.detach().clone())
+        self.register_buffer("rnn1_c0", speller.rnn1_cell_state.detach().clone())
+        self.register_buffer("rnn2_h0", speller.rnn2_hidden_state.detach().clone())
+        self.register_buffer("rnn2_c0", speller.rnn2_cell_state.detach().clone())
+        self.sos = LABEL_MAP['<sos>']
+        self.eos = LABEL_MAP['<eos>']
+        self.max_len_ratio = max_len_ratio
+
+    def encode(self, utterance):
+        """
+        utterance: seq_len * input_size
+        return: (seq_len // reduction) * listener_output_dim
+        """
+        # front end, see model.stack_frames
+        length = utterance.shape[0] // self.frame_stack
+        outputs = utterance[:length * self.frame_stack].reshape(length, -1)
+        if self.frontend is not None:
+            outputs = self.frontend(outputs)
+        outputs = outputs.unsqueeze(1)
+        for i, lstm in enumerate(self.lstm_list):
+            outputs, _ = lstm(outputs)
+            if i < self.pyramid_reductions:
+                # concatenate neighbouring frames: (len // 2) * 1 * (dim * 2)
+                length = outputs.shape[0] // 2
+                outputs = outputs[:length * 2].reshape(length, 1, -1)
+        return outputs.squeeze(1)
+
+    def attend(self, decoder_state, key, value):
+        # 1 * longest_len
+        energy = torch.mm(self.mlp_s(decoder_state), key)
+        attention = F.softmax(energy, dim=1)
+        # same renormalization as AttentionContext.attend (a no-op up to rounding)
+        attention = F.normalize(attention, p=1.0, dim=1)
+        # 1 * value_dim
+        return torch.mm(attention, value)
+
+    def forward(self, utterance):
+        """
+        utterance: seq_len * input_size
+        return: 1d LongTensor of decoded label ids, without <eos>
+        """
+        listener_output = self.encode(utterance)
+        # key: key_dim * longest_len, value: longest_len * value_dim
+        key = self.mlp_h(listener_output).t()
+        value = self.value_projection(listener_output)
+        rnn1_h, rnn1_c = self.rnn1_h0, self.rnn1_c0
+        rnn2_h, rnn2_c = self.rnn2_h0, self.rnn2_c0
+        context = self.attend(rnn2_h, key, value)
+
+        max_len = max(int(math.ceil(listener_output.shape[0] * self.max_len_ratio)), 1)
+        tokens = torch.full([max_len], self.eos, dtype=torch.long, device=utterance.device)
+        preds = torch.full([1], self.sos, dtype=torch.long, device=utterance.device)
+        length = 0
+        for i in range(max_len):
+            inputs = torch.cat((self.embed(preds), context), dim=1)
+            rnn1_h, rnn1_c = self.rnn_layer1(inputs, (rnn1_h, rnn1_c))
+            rnn2_h, rnn2_c = self.rnn_layer2(rnn1_h, (rnn2_h, rnn2_c))
+            context = self.attend(rnn2_h, key, value)
+            prob_linear = self.char_distribution_linear(torch.cat((rnn2_h, context), dim=1))
+            preds = torch.argmax(prob_linear, dim=1)
+            if int(preds[0]) == self.eos:
+                break
+            tokens[i] = preds[0]
+            length += 1
+        return tokens[:length]
+
+def export_las(las, path, max_len_ratio=2.0):
+    """
+    Script, freeze and save the greedy decoder. Load it with torch.jit.load(path);
+    nothing from this repository needs to be importable.
+    """
+    module = ScriptableLAS(copy.deepcopy(las).to("cpu").eval(), max_len_ratio).eval()
+    scripted = torch.jit.freeze(torch.jit.script(module))
+    torch.jit.save(scripted, path)
+    return scripted
+
+def arguments():
+    parser = argparse.ArgumentParser(description="export LAS encoder + greedy decoder to TorchScript")
+    parser.add_argument('--weights', type=str, required=True,
+                        help='training checkpoint')
+    parser.add_argument('--output', type=str, default="./weights/las-greedy.pt")
+    parser.add_argument('--max-len-ratio', type=float, default=2.0,
+                        help='decoded characters per encoder frame at most')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    export_las(load_las(CONF, args.weights), args.output, args.max_len_ratio)
+    print("scripted model written to", args.output)
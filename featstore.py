@@ -0,0 +1,88 @@
+import argparse
+import os
+import numpy as np
+
+# A ragged store keeps variable-length sequences in one contiguous array:
+#   <prefix>.data.npy     all sequences concatenated along the first axis
+#   <prefix>.offsets.npy  int64 offsets, sequence i is data[offsets[i]:offsets[i+1]]
+
+def store_paths(prefix):
+    return prefix + ".data.npy", prefix + ".offsets.npy"
+
+def write_store(sequences, prefix, dtype):
+    """
+    sequences: list of arrays (seq_len * feature_dim or seq_len)
+    """
+    data_path, offsets_path = store_paths(prefix)
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    shape = (int(offsets[-1]),) + np.shape(sequences[0])[1:]
+    # write through a memmap so the concatenated array is never held in RAM
+    tmp_path = data_path + ".tmp"
+    data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+    for i, seq in enumerate(sequences):
+        data[offsets[i]:offsets[i + 1]] = seq
+    data.flush()
+    del data
+    os.replace(tmp_path, data_path)
+    np.save(offsets_path, offsets)
+    return offsets
+
+def write_concatenated(data, offsets, prefix):
+    """
+    Write sequences that are already concatenated.
+    data: sum_len (* feature_dim) array, offsets: int64 array of n + 1 offsets
+    """
+    data_path, offsets_path = store_paths(prefix)
+    tmp_path = data_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp_path, data_path)
+    np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+
+class RaggedStore(object):
+    """
+    Read side of a ragged store. The data file is memory-mapped copy-on-write
+    on first access, so forked DataLoader workers share its pages and indexing
+    returns views instead of copies.
+    """
+    def __init__(self, prefix):
+        self.data_path, offsets_path = store_paths(prefix)
+        self.offsets = np.load(offsets_path)
+        self.lengths = np.diff(self.offsets)
+        self.data = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        if self.data is None:
+            self.data = np.load(self.data_path, mmap_mode="c")
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    def __getstate__(self):
+        # never pickle the mapping itself (e.g. for spawned workers)
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+def convert(npy_path, prefix, dtype):
+    sequences = np.load(npy_path, encoding="bytes", allow_pickle=True)
+    offsets = write_store(sequences, prefix, dtype)
+    print("{}: {} sequences, {} rows -> {}".format(
+        npy_path, len(sequences), offsets[-1], store_paths(prefix)[0]))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="convert object .npy arrays to ragged stores")
+    parser.add_argument('npy_path', type=str,
+                        help='object array of utterances or char transcripts')
+    parser.add_argument('prefix', type=str,
+                        help='output prefix, e.g. ./data/train')
+    parser.add_argument('--dtype', type=str, default="float32",
+                        help='stored dtype: float32/float16 for features, int8 for transcripts')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    convert(args.npy_path, args.prefix, np.dtype(args.dtype))
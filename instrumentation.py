@@ -0,0 +1,212 @@
+import contextlib
+import csv
+import json
+import os
+import resource
+import time
+import torch
+
+class NullMonitor(object):
+    """
+    Monitor that records nothing; used when instrumentation is disabled so the
+    training loop pays a method call per phase and nothing else.
+    """
+    def wrap_loader(self, loader):
+        return loader
+
+    def begin_step(self, epoch, step, inputs, targets):
+        pass
+
+    def phase(self, name):
+        return NULL_PHASE
+
+    def end_step(self, **values):
+        pass
+
+    def close(self):
+        pass
+
+NULL_PHASE = contextlib.nullcontext()
+NULL_MONITOR = NullMonitor()
+
+CSV_FIELDS = [
+    "epoch", "step", "batch_size", "frames", "target_chars", "padding_ratio",
+    "data_s", "listener_s", "speller_s", "teacher_s", "loss_s", "backward_s", "optimizer_s", "step_s",
+    "frames_per_s", "target_chars_per_s", "rss_mb", "peak_rss_mb", "lifetime_peak_rss_mb",
+    "cuda_peak_mb",
+    "loss", "perplexity"
+]
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+def reset_peak_rss():
+    """
+    Reset the kernel's resident set high-water mark (VmHWM) to the current
+    RSS. return: False where /proc/self/clear_refs is unavailable
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    # VmHWM since the last reset_peak_rss()
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError):
+        pass
+    return None
+
+def maxrss_mb():
+    # ru_maxrss is in kilobytes on Linux; reset_peak_rss() resets it as well
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+class TrainingMonitor(NullMonitor):
+    """
+    Records per-step wall time of each phase (data, listener, speller, loss,
+    backward, optimizer), frames/sec, target chars/sec, frame padding ratio and
+    memory, and appends one row per step to a .jsonl or .csv log. peak_rss_mb
+    is the step's own RSS peak (Linux /proc, otherwise empty);
+    lifetime_peak_rss_mb is the process high-water mark.
+    Listener and speller time come from forward hooks on model.listener and
+    model.speller, so the model code is not touched.
+    profile_steps=(start, end) records a torch.profiler trace of global steps
+    [start, end) into profile_dir.
+    """
+    def __init__(self, log_path, model=None, profile_steps=None, profile_dir="./profile"):
+        self.log_path = log_path
+        self.csv = log_path.endswith(".csv")
+        self.log_file = open(log_path, "a")
+        self.csv_writer = None
+        self.cuda = torch.cuda.is_available()
+        self.lifetime_peak_rss = 0
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.global_step = 0
+        self.row = None
+        self.phase_start = {}
+        self.data_time = 0.0
+        if model is not None:
+            for name in ("listener", "speller"):
+                module = getattr(model, name)
+                module.register_forward_pre_hook(self.pre_hook(name))
+                module.register_forward_hook(self.post_hook(name))
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def pre_hook(self, name):
+        def hook(module, inputs):
+            if self.row is not None:
+                self.sync()
+                self.phase_start[name] = time.perf_counter()
+        return hook
+
+    def post_hook(self, name):
+        def hook(module, inputs, outputs):
+            if self.row is not None and name in self.phase_start:
+                self.sync()
+                self.add_time(name, time.perf_counter() - self.phase_start.pop(name))
+        return hook
+
+    def add_time(self, name, seconds):
+        key = name + "_s"
+        self.row[key] = self.row.get(key, 0.0) + seconds
+
+    def wrap_loader(self, loader):
+        iterator = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.data_time = time.perf_counter() - start
+            yield batch
+
+    def begin_step(self, epoch, step, inputs, targets):
+        if self.profile_steps is not None and self.global_step == self.profile_steps[0]:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.profiler = torch.profiler.profile(record_shapes=True, profile_memory=True)
+            self.profiler.__enter__()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self.peak_rss_reset = reset_peak_rss()
+        frames = [len(u) for u in inputs]
+        chars = [len(t) - 1 for t in targets]
+        self.row = {
+            "epoch": epoch,
+            "step": step,
+            "batch_size": len(inputs),
+            "frames": sum(frames),
+            "target_chars": sum(chars),
+            "padding_ratio": 1 - sum(frames) / float(max(frames) * len(frames)),
+            "data_s": self.data_time,
+        }
+        self.sync()
+        self.step_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.sync()
+            self.add_time(name, time.perf_counter() - start)
+
+    def end_step(self, **values):
+        self.sync()
+        row = self.row
+        step_time = time.perf_counter() - self.step_start
+        row["step_s"] = step_time
+        row["frames_per_s"] = row["frames"] / step_time
+        row["target_chars_per_s"] = row["target_chars"] / step_time
+        row["rss_mb"] = current_rss_mb()
+        row["peak_rss_mb"] = peak_rss_mb() if self.peak_rss_reset else None
+        self.lifetime_peak_rss = max(self.lifetime_peak_rss, row["peak_rss_mb"] or 0, maxrss_mb())
+        row["lifetime_peak_rss_mb"] = self.lifetime_peak_rss
+        row["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20 if self.cuda else None
+        row.update(values)
+        self.write(row)
+        self.row = None
+        self.global_step += 1
+        if self.profiler is not None and self.global_step == self.profile_steps[1]:
+            self.stop_profiler()
+
+    def write(self, row):
+        if self.csv:
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.log_file, fieldnames=CSV_FIELDS, extrasaction="ignore")
+                if self.log_file.tell() == 0:
+                    self.csv_writer.writeheader()
+            self.csv_writer.writerow(row)
+        else:
+            self.log_file.write(json.dumps(row) + "\n")
+        self.log_file.flush()
+
+    def stop_profiler(self):
+        self.profiler.__exit__(None, None, None)
+        path = os.path.join(self.profile_dir, "trace-{}-{}.json".format(*self.profile_steps))
+        self.profiler.export_chrome_trace(path)
+        print("profiler trace written to", path)
+        self.profiler = None
+
+    def close(self):
+        if self.profiler is not None:
+            self.stop_profiler()
+        self.log_file.close()
@@ -0,0 +1,85 @@
+import numpy as np
+
+from vocab import LABEL_MAP
+
+def edit_distance(hyp, ref):
+    """
+    Levenshtein distance between two sequences of ints. Each row of the
+    dynamic program is computed with numpy; insertions are resolved with a
+    running minimum instead of a Python loop over the reference.
+    """
+    hyp = np.asarray(hyp, dtype=np.int64)
+    ref = np.asarray(ref, dtype=np.int64)
+    if len(hyp) == 0 or len(ref) == 0:
+        return max(len(hyp), len(ref))
+    steps = np.arange(len(ref) + 1)
+    prev = steps.copy()
+    for i, token in enumerate(hyp):
+        cur = np.empty_like(prev)
+        cur[0] = i + 1
+        # substitution (or match) and deletion
+        cur[1:] = np.minimum(prev[:-1] + (ref != token), prev[1:] + 1)
+        # insertion: cur[j] = min_k (cur[k] + j - k)
+        cur = np.minimum.accumulate(cur - steps) + steps
+        prev = cur
+    return int(prev[-1])
+
+def split_words(sequence):
+    """
+    sequence: label ids without <sos>/<eos>
+    return: list of words, each a tuple of label ids
+    """
+    words = []
+    word = []
+    for token in sequence:
+        if token == LABEL_MAP['<space>']:
+            if len(word) > 0:
+                words.append(tuple(word))
+            word = []
+        else:
+            word.append(token)
+    if len(word) > 0:
+        words.append(tuple(word))
+    return words
+
+def error_counts(hyp, ref):
+    """
+    hyp, ref: label ids without <sos>/<eos>
+    return: (char errors, ref chars, word errors, ref words)
+    """
+    hyp = [int(t) for t in hyp]
+    ref = [int(t) for t in ref]
+    hyp_words, ref_words = split_words(hyp), split_words(ref)
+    vocabulary = {}
+    hyp_ids = [vocabulary.setdefault(w, len(vocabulary)) for w in hyp_words]
+    ref_ids = [vocabulary.setdefault(w, len(vocabulary)) for w in ref_words]
+    return (edit_distance(hyp, ref), len(ref),
+            edit_distance(hyp_ids, ref_ids), len(ref_words))
+
+def corpus_counts(hyps, refs):
+    """
+    return: summed error_counts over the pairs, as an int64 array of 4
+    """
+    totals = np.zeros(4, dtype=np.int64)
+    for hyp, ref in zip(hyps, refs):
+        totals += error_counts(hyp, ref)
+    return totals
+
+def counts_to_rates(totals):
+    """
+    return: (CER, WER) from summed error_counts
+    """
+    return float(totals[0]) / max(totals[1], 1), float(totals[2]) / max(totals[3], 1)
+
+def error_rates(hyps, refs, executor=None, chunk_size=64):
+    """
+    return: (CER, WER) over a corpus of hypotheses and references
+    executor: optional concurrent.futures pool; the corpus is split into
+    chunks of chunk_size pairs whose counts are computed in parallel
+    """
+    if executor is None:
+        return counts_to_rates(corpus_counts(hyps, refs))
+    hyps, refs = list(hyps), list(refs)
+    futures = [executor.submit(corpus_counts, hyps[i:i + chunk_size], refs[i:i + chunk_size])
+               for i in range(0, len(hyps), chunk_size)]
+    return counts_to_rates(sum((future.result() for future in futures), np.zeros(4, dtype=np.int64)))
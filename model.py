@@ -3,26 +3,143 @@ import torch
 import torch.nn as nn
 from torch.nn.utils import rnn
 import torch.nn.functional as F
-from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
+import math
 import numpy as np
 from vocab import LABEL_MAP
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+def length_mask(lengths, max_len):
+    """
+    lengths: list or 1d tensor of valid lengths
+    return: batch_size * max_len BoolTensor, True at valid positions
+    """
+    lengths = torch.as_tensor(lengths, device=DEVICE)
+    steps = torch.arange(max_len, device=DEVICE)
+    return steps.unsqueeze(0) < lengths.unsqueeze(1)
+
+def sequence_loss(probs, targets_for_loss, targets_length_for_loss, criterion):
+    """
+    probs: batch_size * timestep * class_size (unnormalized scores)
+    targets_for_loss: batch_size * timestep
+    criterion: CrossEntropyLoss(reduction="sum"); padded positions are set to
+    its ignore_index so the whole batch is scored in one call
+    return: summed loss, number of scored tokens
+    """
+    mask = length_mask(targets_length_for_loss, targets_for_loss.shape[1])
+    masked_targets = targets_for_loss.masked_fill(~mask, criterion.ignore_index)
+    loss = criterion(probs.reshape(-1, probs.shape[-1]), masked_targets.reshape(-1))
+    return loss, int(mask.sum())
+
+def distillation_loss(probs, teacher_probs, targets_length_for_loss, temperature=1.0):
+    """
+    probs, teacher_probs: batch_size * timestep * class_size scores of the
+    student and of a teacher fed the same input characters
+    return: summed KL(teacher || student) of the temperature-softened
+    distributions over unpadded positions, scaled by temperature ** 2 so its
+    gradients keep the magnitude of the cross entropy
+    """
+    mask = length_mask(targets_length_for_loss, probs.shape[1])
+    log_probs = F.log_softmax(probs[mask].float() / temperature, dim=-1)
+    teacher_log_probs = F.log_softmax(teacher_probs[mask].float() / temperature, dim=-1)
+    kl = F.kl_div(log_probs, teacher_log_probs, reduction="sum", log_target=True)
+    return kl * temperature ** 2
+
+def decoding_lengths(outputs_length, timestep=None, max_len_ratio=2.0):
+    """
+    Per-utterance decoding budget derived from the encoder length:
+    ceil(outputs_length * max_len_ratio), capped by timestep when given.
+    return: 1d LongTensor on DEVICE
+    """
+    outputs_length = torch.as_tensor(outputs_length, device=DEVICE)
+    max_lens = torch.ceil(outputs_length.float() * max_len_ratio).long().clamp(min=1)
+    if timestep is not None:
+        max_lens = max_lens.clamp(max=timestep)
+    return max_lens
+
+def pyramid_reduce(packed):
+    """
+    Concatenate every two consecutive frames of each sequence of a
+    PackedSequence without unpacking it: a sequence of length L becomes L // 2
+    frames of twice the dimension (an odd last frame is dropped). Rows of time
+    step t start at sum(batch_sizes[:t]), so both source rows of every output
+    row are found with one index computed on the data's device, and the data
+    is copied once by a single index_select.
+    """
+    data, batch_sizes = packed.data, packed.batch_sizes
+    # batch_sizes stays on the CPU as PackedSequence requires;
+    # sequences longer than 2t+1 frames have an output frame t
+    new_batch_sizes = batch_sizes[1::2].contiguous()
+    total = int(new_batch_sizes.sum())
+    sizes = batch_sizes.to(data.device)
+    offsets = torch.cumsum(sizes, dim=0) - sizes
+    half = sizes[1::2]
+    # output time step of every output row, and its position within the step
+    step = torch.repeat_interleave(torch.arange(len(half), device=data.device), half, output_size=total)
+    position = torch.arange(total, device=data.device) - (torch.cumsum(half, dim=0) - half)[step]
+    even = offsets[2 * step] + position
+    odd = offsets[2 * step + 1] + position
+    index = torch.stack((even, odd), dim=1).view(-1)
+    new_data = data.index_select(0, index).view(total, -1)
+    return rnn.PackedSequence(new_data, new_batch_sizes)
+
+def pyramid_reductions(nlayers, frame_stack=1):
+    """
+    Number of pyramid (2x) reductions between Listener layers. Frame stacking
+    takes over about log2(frame_stack) of them, so the overall time reduction
+    stays near 2 ** (nlayers - 1).
+    """
+    return max(nlayers - 1 - int(round(math.log2(frame_stack))), 0)
+
+def stack_frames(utterance, frame_stack):
+    """
+    utterance: seq_len * input_size
+    return: (seq_len // frame_stack) * (input_size * frame_stack), a view
+    that concatenates every frame_stack consecutive frames (a trailing
+    partial group is dropped)
+    """
+    length = len(utterance) // frame_stack
+    return utterance[:length * frame_stack].reshape(length, -1)
+
 class Listener(nn.Module):
-    def __init__(self, input_size, hidden_size, nlayers):
+    def __init__(self, input_size, hidden_size, nlayers, recompute=False,
+                 frame_stack=1, frontend_dim=0):
+        """
+        recompute: keep only each layer's (reduced) input during training and
+        recompute the BLSTM activations in the backward pass
+        frame_stack: front end that concatenates and subsamples every
+        frame_stack input frames before the first BLSTM, which then runs over
+        a frame_stack times shorter sequence; the pyramid drops
+        log2(frame_stack) of its reductions to keep the overall reduction
+        frontend_dim: when > 0, a linear projection of the stacked frames to
+        this size (a strided projection over the original frames)
+        """
         super(Listener, self).__init__()
         self.input_size = input_size
         self.nlayers = nlayers
+        self.recompute = recompute
+        self.frame_stack = frame_stack
+        self.pyramid_reductions = pyramid_reductions(nlayers, frame_stack)
+        # input frames per encoder output frame
+        self.reduction = frame_stack * 2 ** self.pyramid_reductions
+        stacked_size = input_size * frame_stack
+        if frontend_dim > 0:
+            self.frontend = nn.Linear(stacked_size, frontend_dim)
+            stacked_size = frontend_dim
+        else:
+            self.frontend = None
         lstm_list = []
         for i in range(nlayers):
             if i == 0:
-                lstm = nn.LSTM(input_size=input_size,
+                lstm = nn.LSTM(input_size=stacked_size,
                                hidden_size=hidden_size,
                                num_layers=1,
                                bidirectional=True)
             else:
-                lstm = nn.LSTM(input_size=hidden_size * 2 * 2,
+                # layers after a pyramid reduction see two concatenated frames
+                reduced = i - 1 < self.pyramid_reductions
+                lstm = nn.LSTM(input_size=hidden_size * 2 * (2 if reduced else 1),
                                hidden_size=hidden_size,
                                num_layers=1,
                                bidirectional=True)
@@ -30,48 +147,62 @@ class Listener(nn.Module):
             lstm_list.append(lstm)
         self.lstm_list = nn.ModuleList(lstm_list)
 
-    def forward(self, inputs_list): # batch_size * var_seq_len * 40
-        batch_size = len(inputs_list)
+    def layer(self, i, data, batch_sizes):
+        """
+        BLSTM layer i followed by a pyramid reduction (for the first
+        pyramid_reductions layers), on the data of a PackedSequence
+        """
+        lstm_outputs, _ = self.lstm_list[i](rnn.PackedSequence(data, batch_sizes))
+        if i < self.pyramid_reductions:
+            # sum_len/2 * (hidden_size*2*2), still packed
+            lstm_outputs = pyramid_reduce(lstm_outputs)
+        return lstm_outputs.data, lstm_outputs.batch_sizes
+
+    def output_lengths(self, inputs_length):
+        """
+        inputs_length: 1d LongTensor of utterance lengths in frames
+        return: 1d LongTensor of encoder output lengths
+        """
+        return inputs_length // self.reduction
 
+    def forward(self, inputs_list): # batch_size * var_seq_len * 40
         inputs_length = [len(utterance) for utterance in inputs_list] # original utterance lengths
         inputs_length = torch.LongTensor(inputs_length)
-        outputs_length = inputs_length // 8 # output utterance lengths
+        outputs_length = self.output_lengths(inputs_length) # output utterance lengths
 
+        if self.frame_stack > 1:
+            # stacking keeps the longest-first order
+            inputs_list = [stack_frames(utterance, self.frame_stack) for utterance in inputs_list]
         # packed_inputs.data.shape: (sum_len * 40)
         packed_inputs = rnn.pack_sequence(inputs_list).to(DEVICE)
 
+        data, batch_sizes = packed_inputs.data, packed_inputs.batch_sizes
+        if self.frontend is not None:
+            data = self.frontend(data)
+        recompute = self.recompute and self.training and torch.is_grad_enabled()
         for i in range(self.nlayers):
-            # lstm_output: sum_len * (hidden_size*2)
-            lstm_outputs, _ = self.lstm_list[i](packed_inputs)
-
-            # unpacked_outputs shape: max_len * batch_size * (hidden_size*2)
-            unpacked_outputs, _ = rnn.pad_packed_sequence(lstm_outputs)
-
-            if i != self.nlayers - 1:
-                longest_len = unpacked_outputs.shape[0]
-                dim = unpacked_outputs.shape[2]
-                # transpose lstm output to batch_size * longest_len * dim
-                unpacked_outputs = unpacked_outputs.permute(1, 0, 2)
-                # chop off the extra
-                if longest_len % 2 != 0:
-                    unpacked_outputs = unpacked_outputs[:,0:-1,...]
-                longest_len = longest_len // 2
-                dim = dim * 2
-                # reshape to batch_size * (longest_len/2) * (dim*2)
-                unpacked_outputs = unpacked_outputs.contiguous().view(-1, longest_len, dim)
-                # transpose back to (longest_len/2) * batch_size * (dim*2)
-                unpacked_outputs = unpacked_outputs.permute(1, 0, 2)
-                lengths = inputs_length // (2 ** (i+1))
-                packed_inputs = rnn.pack_padded_sequence(unpacked_outputs, lengths)
+            if recompute:
+                data, batch_sizes = checkpoint(self.layer, i, data, batch_sizes, use_reentrant=False)
+            else:
+                data, batch_sizes = self.layer(i, data, batch_sizes)
 
         # batch_size * longest_len * (hidden_size*2)
-        unpacked_outputs = unpacked_outputs.transpose(0, 1)
+        unpacked_outputs, _ = rnn.pad_packed_sequence(rnn.PackedSequence(data, batch_sizes), batch_first=True)
         # outputs_length is a 1d tensor
         return unpacked_outputs, outputs_length
 
 class Speller(nn.Module):
     def __init__(self, listener_hidden_dim, speller_hidden_dim,
-                 embedding_dim, class_size, key_dim, value_dim, batch_size):
+                 embedding_dim, class_size, key_dim, value_dim, batch_size,
+                 recompute_segment=0, attention_window=0):
+        """
+        recompute_segment: when > 0, training keeps only the decoder state at
+        the boundaries of segments of this many steps and recomputes the
+        steps inside a segment in the backward pass
+        attention_window: when > 0, each step attends to this many encoder
+        frames around the previous attention peak (AttentionContext.attend_window);
+        batches whose encoder output fits in the window use full attention
+        """
         super(Speller, self).__init__()
         rnn_input_size = embedding_dim + value_dim
         self.rnn_layer1 = nn.LSTMCell(input_size=rnn_input_size, hidden_size=speller_hidden_dim)
@@ -88,130 +219,288 @@ class Speller(nn.Module):
         self.rnn2_hidden_state = nn.Parameter(torch.zeros(1, speller_hidden_dim)).to(DEVICE)
         self.rnn2_cell_state = nn.Parameter(torch.zeros(1, speller_hidden_dim)).to(DEVICE)
         self.speller_hidden_dim = speller_hidden_dim
+        self.class_size = class_size
+        self.recompute_segment = recompute_segment
+        self.attention_window = attention_window
+
+    def initial_state(self, batch_size):
+        """
+        return: (rnn1_h, rnn1_c, rnn2_h, rnn2_c), each batch_size * speller_hidden_dim,
+        followed in windowed attention mode by the attention peak of every
+        utterance (1d LongTensor, starting at frame 0)
+        """
+        rnn1_h = self.rnn1_hidden_state.expand(batch_size, self.speller_hidden_dim)
+        rnn1_c = self.rnn1_cell_state.expand(batch_size, self.speller_hidden_dim)
+        rnn2_h = self.rnn2_hidden_state.expand(batch_size, self.speller_hidden_dim)
+        rnn2_c = self.rnn2_cell_state.expand(batch_size, self.speller_hidden_dim)
+        if self.attention_window > 0:
+            peak = torch.zeros(batch_size, dtype=torch.long, device=DEVICE)
+            return rnn1_h, rnn1_c, rnn2_h, rnn2_c, peak
+        return rnn1_h, rnn1_c, rnn2_h, rnn2_c
 
-    def forward(self, listener_output, outputs_length, targets, teacher_forcing):
+    def step(self, embed, context, state, key, value, attention_mask):
+        """
+        One decoder step.
+        embed: batch_size * embedding_dim, embedding of the previous character
+        context: batch_size * value_dim, context of the previous step
+        state: from initial_state or the previous step
+        key, value, attention_mask: from AttentionContext.project
+        return: prob_linear (batch_size * class_size), context, attention, state;
+        in windowed mode attention covers the window only (batch_size * 1 * window)
+        """
+        rnn1_h, rnn1_c, rnn2_h, rnn2_c = state[:4]
+        inputs = torch.cat((embed, context), dim=1)
+        rnn1_h, rnn1_c = self.rnn_layer1(inputs, (rnn1_h, rnn1_c))
+        rnn2_h, rnn2_c = self.rnn_layer2(rnn1_h, (rnn2_h, rnn2_c))
+
+        # decoder_state: batch_size * speller_hidden_dim
+        decoder_state = rnn2_h
+        # batch_size * value_dim
+        if len(state) == 4:
+            context, attention = self.attention.attend(decoder_state, key, value, attention_mask)
+            peak = ()
+        elif key.shape[2] > self.attention_window:
+            context, attention, peak = self.attention.attend_window(
+                decoder_state, key, value, attention_mask, state[4], self.attention_window)
+            peak = (peak,)
+        else:
+            # the whole encoder output fits in the window
+            context, attention = self.attention.attend(decoder_state, key, value, attention_mask)
+            peak = (attention.squeeze(1).argmax(dim=1),)
+        # batch_size * (speller_hiddem_dim + value_dim)
+        concat_input = torch.cat((decoder_state, context), dim=1)
+        # batch_size * class_size
+        prob_linear = self.char_distribution_linear(concat_input)
+        return prob_linear, context, attention, (rnn1_h, rnn1_c, rnn2_h, rnn2_c) + peak
+
+    def forward(self, listener_output, outputs_length, targets, teacher_forcing, record_attention=False):
+        """
+        record_attention: also return every step's attention (detached), for
+        inspection; off by default so training does not hold on to them
+        """
         targets_length_for_loss = [len(transcript)-1 for transcript in targets] # original transcript length - 1
         timestep = max(targets_length_for_loss) # max_transcript_len - 1
         # batch_size * max_transcript_len (LongTensor)
         padded_targets = rnn.pad_sequence(targets, batch_first=True).long().to(DEVICE)
         targets_for_loss = padded_targets[:,1:] # only need targets starting from index 1
 
+        batch_size = len(listener_output)
+        state = self.initial_state(batch_size)
+        key, value, attention_mask = self.attention.project(listener_output, outputs_length)
+        context, attention = self.attention.attend(state[2], key, value, attention_mask)
+        # draw the teacher forcing decisions up front so recomputed segments replay them
+        forced = [i == 0 or np.random.random() < teacher_forcing for i in range(timestep)]
+        preds = padded_targets[:,0]
+
+        segment = timestep
+        recompute = self.recompute_segment > 0 and self.training and torch.is_grad_enabled()
+        if recompute:
+            segment = self.recompute_segment
         probs = []
         predictions = []
         attentions = []
-
-        batch_size = len(listener_output)
-        rnn1_h = self.rnn1_hidden_state.expand(batch_size, self.speller_hidden_dim)
-        rnn1_c = self.rnn1_cell_state.expand(batch_size, self.speller_hidden_dim)
-        rnn2_h = self.rnn2_hidden_state.expand(batch_size, self.speller_hidden_dim)
-        rnn2_c = self.rnn2_cell_state.expand(batch_size, self.speller_hidden_dim)
-        context, attention = self.attention(rnn2_h, listener_output, outputs_length)
-
-        for i in range(timestep):
-            if i != 0:
-                if np.random.random() < teacher_forcing:
-                    # embed input is a 1d tensor
-                    # batch_size * embedding_dim
-                    embed = self.embed(padded_targets[:,i])
-                else:
-                    embed = self.embed(preds)
-                inputs = torch.cat((embed, context), dim=1)
-                rnn1_h, rnn1_c = self.rnn_layer1(inputs, (rnn1_h, rnn1_c))
-                rnn2_h, rnn2_c = self.rnn_layer2(rnn1_h, (rnn2_h, rnn2_c))
-            else: # i == 0
-                embed = self.embed(padded_targets[:,0])
-                inputs = torch.cat((embed, context), dim=1)
-                rnn1_h, rnn1_c = self.rnn_layer1(inputs, (rnn1_h, rnn1_c))
-                rnn2_h, rnn2_c = self.rnn_layer2(rnn1_h, (rnn2_h, rnn2_c))
-
-            # decoder_state: batch_size * listener_hidden_dim
-            decoder_state = rnn2_h
-            # batch_size * value_dim
-            context, attention = self.attention(decoder_state, listener_output, outputs_length)
-            # batch_size * (speller_hiddem_dim + value_dim)
-            concat_input = torch.cat((decoder_state, context), dim=1)
-            # batch_size * class_size
-            prob_linear = self.char_distribution_linear(concat_input)
-            # batch_size * max_transcript_len
-            prob_distribution = self.softmax(prob_linear)
-            # 2d tensor
-            index = torch.multinomial(prob_distribution, num_samples=1)
-            # index = torch.argmax(prob_distribution, dim=1).reshape(-1, 1)
-            preds = torch.squeeze(index)
-            probs.append(prob_linear)
-            predictions.append(preds)
-            attentions.append(attention)
+        for start in range(0, timestep, segment):
+            end = min(start + segment, timestep)
+            args = (start, end, forced, padded_targets, preds, context, state, key, value, attention_mask,
+                    record_attention)
+            if recompute:
+                # the RNG state is restored on recomputation, so multinomial draws match
+                outputs = checkpoint(self.decode_segment, *args, use_reentrant=False)
+            else:
+                outputs = self.decode_segment(*args)
+            segment_probs, segment_predictions, segment_attentions, preds, context, state = outputs
+            probs.append(segment_probs)
+            predictions.append(segment_predictions)
+            attentions += segment_attentions
 
         # probs: batch_size * (timestep-1) * n_classes
-        probs = torch.stack(probs, dim=1)
+        probs = torch.cat(probs, dim=1)
         # batch_size * timestep
-        predictions = torch.stack(predictions, dim=1)
+        predictions = torch.cat(predictions, dim=1)
         # targets_for_loss: batch_size * timestep
         # targets length for loss: a list of len_for_loss (original_len - 1)
         return probs, predictions, targets_for_loss, targets_length_for_loss, attentions
 
-    def inference(self, listener_output, outputs_length, timestep):
-        batch_size = len(listener_output)
-        rnn1_h = self.rnn1_hidden_state.expand(batch_size, self.speller_hidden_dim)
-        rnn1_c = self.rnn1_cell_state.expand(batch_size, self.speller_hidden_dim)
-        rnn2_h = self.rnn2_hidden_state.expand(batch_size, self.speller_hidden_dim)
-        rnn2_c = self.rnn2_cell_state.expand(batch_size, self.speller_hidden_dim)
-        context, attention = self.attention(rnn2_h, listener_output, outputs_length)
-
+    def decode_segment(self, start, end, forced, padded_targets, preds, context, state,
+                       key, value, attention_mask, record_attention=False):
+        """
+        Training steps [start, end) of Speller.forward.
+        forced[i]: feed the ground truth instead of the sampled prediction at step i
+        return: probs (batch_size * steps * class_size), predictions
+                (batch_size * steps), list of attentions (empty unless
+                record_attention), and the last prediction, context and
+                state to continue from
+        """
+        probs = []
         predictions = []
-        preds = torch.tensor([LABEL_MAP['<sos>'] for i in range(len(listener_output))]).to(DEVICE)
         attentions = []
-
-        for i in range(timestep):
-            if i == 0:
-                embed_input = preds
-                embed = self.embed(preds)
-                inputs = torch.cat((embed, context), dim=1)
-                rnn1_h, rnn1_c = self.rnn_layer1(inputs, (rnn1_h, rnn1_c))
-                rnn2_h, rnn2_c = self.rnn_layer2(rnn1_h, (rnn2_h, rnn2_c))
+        for i in range(start, end):
+            # embed input is a 1d tensor
+            # batch_size * embedding_dim
+            if forced[i]:
+                embed = self.embed(padded_targets[:,i])
             else:
-                if batch_size == 1:
-                    embed_input = preds.unsqueeze(dim=0)
-                else:
-                    embed_input = preds
-                embed = self.embed(embed_input)
-                inputs = torch.cat((embed, context), dim=1)
-                rnn1_h, rnn1_c = self.rnn_layer1(inputs, (rnn1_h, rnn1_c))
-                rnn2_h, rnn2_c = self.rnn_layer2(rnn1_h, (rnn2_h, rnn2_c))
-
-            # decoder_state: batch_size * listener_hidden_dim
-            decoder_state = rnn2_h
-            # batch_size * value_dim
-            context, attention = self.attention(decoder_state, listener_output, outputs_length)
-            # batch_size * (speller_hiddem_dim + value_dim)
-            concat_input = torch.cat((decoder_state, context), dim=1)
-            # batch_size * class_size
-            prob_linear = self.char_distribution_linear(concat_input)
+                embed = self.embed(preds)
+
+            # prob_linear: batch_size * class_size
+            prob_linear, context, attention, state = self.step(embed, context, state,
+                                                               key, value, attention_mask)
             # batch_size * max_transcript_len
             prob_distribution = self.softmax(prob_linear)
             # 2d tensor
-            index = torch.argmax(prob_distribution, dim=1).reshape(-1, 1)
-            preds = torch.squeeze(index)
+            index = torch.multinomial(prob_distribution, num_samples=1)
+            # index = torch.argmax(prob_distribution, dim=1).reshape(-1, 1)
+            preds = index.squeeze(1)
+            probs.append(prob_linear)
             predictions.append(preds)
-            attentions.append(attention)
+            if record_attention:
+                attentions.append(attention.detach())
+        return (torch.stack(probs, dim=1), torch.stack(predictions, dim=1), attentions,
+                preds, context, state)
 
-        if batch_size == 1:
-            predictions = torch.stack(predictions, dim=0)
-            predictions = predictions.reshape(1, -1)
-        else:
-            # batch_size * timestep
-            predictions = torch.stack(predictions, dim=1)
-        prediction_list = []
-        for i in range(len(predictions)):
-            tmp = []
-            for j in range(timestep):
-                if predictions[i][j] == LABEL_MAP['<eos>']:
-                    tmp = predictions[i][:j]
+    def inference(self, listener_output, outputs_length, timestep=None, max_len_ratio=2.0):
+        """
+        Greedy decoding that stops once every utterance has emitted <eos>.
+        Finished utterances are dropped from the active batch, and each
+        utterance is decoded for at most ceil(outputs_length * max_len_ratio)
+        steps, further capped by timestep when it is given.
+        return: a list of 1d LongTensors, truncated before <eos>
+        """
+        batch_size = len(listener_output)
+        state = self.initial_state(batch_size)
+        key, value, attention_mask = self.attention.project(listener_output, outputs_length)
+        context, attention = self.attention.attend(state[2], key, value, attention_mask)
+
+        max_lens = decoding_lengths(outputs_length, timestep, max_len_ratio)
+        max_steps = int(max_lens.max())
+
+        # batch_size * max_steps, filled with <eos> past each hypothesis
+        predictions = torch.full((batch_size, max_steps), LABEL_MAP['<eos>'], dtype=torch.long, device=DEVICE)
+        lengths = max_lens.clone()
+        # indices into the full batch of the utterances still being decoded
+        active = torch.arange(batch_size, device=DEVICE)
+        preds = torch.full((batch_size,), LABEL_MAP['<sos>'], dtype=torch.long, device=DEVICE)
+
+        for i in range(max_steps):
+            embed = self.embed(preds)
+            # prob_linear: n_active * class_size
+            prob_linear, context, attention, state = self.step(embed, context, state,
+                                                               key, value, attention_mask)
+            preds = torch.argmax(prob_linear, dim=1)
+            predictions[active, i] = preds
+
+            ended = preds == LABEL_MAP['<eos>']
+            lengths[active[ended]] = i
+            finished = ended | (max_lens[active] <= i + 1)
+            if bool(finished.any()):
+                keep = ~finished
+                if not bool(keep.any()):
+                    break
+                active = active[keep]
+                preds = preds[keep]
+                context = context[keep]
+                state = tuple(s[keep] for s in state)
+                key, value, attention_mask = key[keep], value[keep], attention_mask[keep]
+
+        lengths = lengths.tolist()
+        return [predictions[i, :lengths[i]] for i in range(batch_size)] # a list of tensors
+
+
+    def beam_search(self, listener_output, outputs_length, beam_width,
+                    length_penalty=1.0, timestep=None, max_len_ratio=2.0):
+        """
+        Batched beam search. All batch_size * beam_width hypotheses run through
+        the decoder as one tensor; each step keeps the beam_width best
+        candidates per utterance ranked by score / length ** length_penalty.
+        Hypotheses that emitted <eos> keep their slot with a frozen score, and
+        an utterance leaves the active batch once all of its beams are finished
+        or its decoding budget (see decoding_lengths) is used up.
+        return: a list of 1d LongTensors, the best hypothesis per utterance
+        """
+        batch_size = len(listener_output)
+        eos = LABEL_MAP['<eos>']
+        key, value, attention_mask = self.attention.project(listener_output, outputs_length)
+        # (batch_size * beam_width) rows, beams of one utterance are adjacent
+        key = key.repeat_interleave(beam_width, dim=0)
+        value = value.repeat_interleave(beam_width, dim=0)
+        attention_mask = attention_mask.repeat_interleave(beam_width, dim=0)
+        nrows = batch_size * beam_width
+        state = self.initial_state(nrows)
+        context, attention = self.attention.attend(state[2], key, value, attention_mask)
+
+        max_lens = decoding_lengths(outputs_length, timestep, max_len_ratio)
+        max_steps = int(max_lens.max())
+        best_tokens = torch.full((batch_size, max_steps), eos, dtype=torch.long, device=DEVICE)
+        best_lengths = torch.zeros(batch_size, dtype=torch.long, device=DEVICE)
+
+        # n_active * beam_width * max_steps token history
+        tokens = torch.full((batch_size, beam_width, max_steps), eos, dtype=torch.long, device=DEVICE)
+        # only the first beam is live at the start so the beams do not duplicate
+        scores = torch.full((batch_size, beam_width), float('-inf'), device=DEVICE)
+        scores[:, 0] = 0
+        lengths = torch.zeros((batch_size, beam_width), dtype=torch.long, device=DEVICE)
+        finished = torch.zeros((batch_size, beam_width), dtype=torch.bool, device=DEVICE)
+        # a finished hypothesis can only be extended by <eos>, at no cost
+        frozen_log_probs = torch.full((self.class_size,), float('-inf'), device=DEVICE)
+        frozen_log_probs[eos] = 0
+        not_eos = torch.ones(self.class_size, dtype=torch.long, device=DEVICE)
+        not_eos[eos] = 0
+        active = torch.arange(batch_size, device=DEVICE)
+        preds = torch.full((nrows,), LABEL_MAP['<sos>'], dtype=torch.long, device=DEVICE)
+
+        for i in range(max_steps):
+            n_active = len(active)
+            embed = self.embed(preds)
+            prob_linear, context, attention, state = self.step(embed, context, state,
+                                                               key, value, attention_mask)
+            # n_active * beam_width * class_size
+            log_probs = F.log_softmax(prob_linear, dim=-1).view(n_active, beam_width, -1)
+            log_probs = torch.where(finished.unsqueeze(2), frozen_log_probs, log_probs)
+
+            candidate_scores = scores.unsqueeze(2) + log_probs
+            candidate_lengths = lengths.unsqueeze(2) + (~finished).long().unsqueeze(2) * not_eos
+            normalized = candidate_scores / candidate_lengths.clamp(min=1).float() ** length_penalty
+            # prune to the beam_width best candidates of each utterance
+            _, top = normalized.view(n_active, -1).topk(beam_width, dim=1)
+            origin = torch.div(top, self.class_size, rounding_mode='floor')
+            preds = top % self.class_size
+
+            scores = candidate_scores.view(n_active, -1).gather(1, top)
+            lengths = candidate_lengths.view(n_active, -1).gather(1, top)
+            finished = finished.gather(1, origin) | (preds == eos)
+            tokens = tokens.gather(1, origin.unsqueeze(2).expand(-1, -1, max_steps))
+            tokens[:, :, i] = preds
+            finished = finished | (max_lens[active] <= i + 1).unsqueeze(1)
+
+            # reorder decoder state to follow the surviving beams
+            rows = (torch.arange(n_active, device=DEVICE) * beam_width).unsqueeze(1) + origin
+            rows = rows.view(-1)
+            preds = preds.view(-1)
+            context = context[rows]
+            state = tuple(s[rows] for s in state)
+
+            done = finished.all(dim=1)
+            if bool(done.any()):
+                normalized = scores[done] / lengths[done].clamp(min=1).float() ** length_penalty
+                best = normalized.argmax(dim=1)
+                index = torch.arange(len(best), device=DEVICE)
+                best_tokens[active[done]] = tokens[done][index, best]
+                best_lengths[active[done]] = lengths[done][index, best]
+
+                keep = ~done
+                if not bool(keep.any()):
                     break
-            if len(tmp) == 0:
-                tmp = predictions[i]
-            prediction_list.append(tmp)
-        return prediction_list # a list of tensors
+                keep_rows = keep.repeat_interleave(beam_width)
+                active = active[keep]
+                tokens, scores = tokens[keep], scores[keep]
+                lengths, finished = lengths[keep], finished[keep]
+                preds, context = preds[keep_rows], context[keep_rows]
+                state = tuple(s[keep_rows] for s in state)
+                key, value = key[keep_rows], value[keep_rows]
+                attention_mask = attention_mask[keep_rows]
+
+        best_lengths = best_lengths.tolist()
+        return [best_tokens[i, :best_lengths[i]] for i in range(batch_size)] # a list of tensors
 
 
 class AttentionContext(nn.Module):
@@ -225,69 +514,138 @@ class AttentionContext(nn.Module):
         self.value_projection = nn.Linear(in_features=h_input_size, out_features=value_dim)
         self.softmax = nn.Softmax(dim=2)
 
-    def forward(self, decoder_state, listener_output, outputs_length):
+    def project(self, listener_output, outputs_length):
         """
-        decoder_state: batch_size * decoder_hidden_dim
+        Project the encoder output once per utterance batch.
         listener_output: batch_size * longest_len * listener_output_dim
+        return: key (batch_size * key_dim * longest_len),
+                value (batch_size * longest_len * value_dim),
+                attention_mask (batch_size * 1 * longest_len)
         """
-        decoder_state = decoder_state.to(DEVICE)
-        # query: batch_size * 1 * decoder_hidden_dim
-        query = torch.unsqueeze(decoder_state, dim=1)
-        # after projection, query: batch_size * 1 * key_dim
-        query = self.mlp_s(query)
-
         listener_output = listener_output.to(DEVICE)
-        # key: batch_size * key_dim * listener_output_dim
-        key = self.mlp_h(listener_output)
-        key = key.transpose(1, 2)
-        # energy: batch_size * 1 * listener_output_dim
+        # key: batch_size * key_dim * longest_len
+        key = self.mlp_h(listener_output).transpose(1, 2)
+        # value: batch_size * longest_len * value_dim
+        value = self.value_projection(listener_output)
+        attention_mask = length_mask(outputs_length, listener_output.shape[1])
+        attention_mask = attention_mask.unsqueeze(1).to(value.dtype)
+        return key, value, attention_mask
+
+    def attend(self, decoder_state, key, value, attention_mask):
+        """
+        One decoder step against keys and values from project().
+        decoder_state: batch_size * decoder_hidden_dim
+        """
+        # query: batch_size * 1 * key_dim
+        query = self.mlp_s(torch.unsqueeze(decoder_state, dim=1))
+        # energy: batch_size * 1 * longest_len
         energy = torch.bmm(query, key)
-        # attention: batch_size * 1 * listener_output_dim
+        # attention: batch_size * 1 * longest_len
         attention = self.softmax(energy)
-        attention_mask = torch.ones(attention.shape).to(DEVICE)
-        for i in range(listener_output.shape[0]):
-            if i != 0:
-                attention_mask[i, :, outputs_length[i]:] = 0
-        attention_mask = Variable(attention_mask)
         attention = attention * attention_mask
         attention = F.normalize(attention, p=1, dim=2)
-        # batch_size * listener_output_dim * value_dim
-        value = self.value_projection(listener_output)
-        # utterance_mask = torch.ones(value.shape).to(DEVICE)
-        # for i in range(listener_output.shape[0]):
-        #     if i != 0:
-        #         utterance_mask[i][:][outputs_length[i]:] = 0
-        # value = value * utterance_mask
-
         # context: batch_size * 1 * value_dim
         context = torch.bmm(attention, value)
         # context: batch_size * value_dim
         context = torch.squeeze(context, dim=1)
         return context, attention
 
+    def attend_window(self, decoder_state, key, value, attention_mask, peak, window):
+        """
+        attend() over the window frames starting a quarter window before the
+        previous attention peak, clamped into the padded encoder output, so a
+        step costs O(window) instead of O(longest_len). Requires
+        window < longest_len.
+        peak: 1d LongTensor, encoder frame of each utterance's previous peak
+        return: context (batch_size * value_dim), attention
+                (batch_size * 1 * window), new peak
+        """
+        longest_len = key.shape[2]
+        start = (peak - window // 4).clamp(min=0, max=longest_len - window)
+        # batch_size * window encoder frame indices
+        index = start.unsqueeze(1) + torch.arange(window, device=key.device)
+        key = key.gather(2, index.unsqueeze(1).expand(-1, key.shape[1], -1))
+        value = value.gather(1, index.unsqueeze(2).expand(-1, -1, value.shape[2]))
+        attention_mask = attention_mask.gather(2, index.unsqueeze(1))
+        context, attention = self.attend(decoder_state, key, value, attention_mask)
+        return context, attention, start + attention.squeeze(1).argmax(dim=1)
+
+    def forward(self, decoder_state, listener_output, outputs_length):
+        """
+        decoder_state: batch_size * decoder_hidden_dim
+        listener_output: batch_size * longest_len * listener_output_dim
+        """
+        key, value, attention_mask = self.project(listener_output, outputs_length)
+        return self.attend(decoder_state.to(DEVICE), key, value, attention_mask)
+
 class LAS(nn.Module):
     def __init__(self, input_size, listener_hidden_size, nlayers,
                  speller_hidden_dim, embedding_dim,
-                 class_size, key_dim, value_dim, batch_size):
+                 class_size, key_dim, value_dim, batch_size,
+                 recompute_listener=False, recompute_segment=0, attention_window=0,
+                 frame_stack=1, frontend_dim=0):
         super(LAS, self).__init__()
-        self.listener = Listener(input_size=40, hidden_size=listener_hidden_size, nlayers=4)
+        self.listener = Listener(input_size=input_size, hidden_size=listener_hidden_size, nlayers=nlayers,
+                                 recompute=recompute_listener, frame_stack=frame_stack,
+                                 frontend_dim=frontend_dim)
         self.listener = self.listener.to(DEVICE)
         self.speller = Speller(listener_hidden_size*2, speller_hidden_dim,
                                embedding_dim, class_size, key_dim, value_dim,
-                               batch_size)
+                               batch_size, recompute_segment=recompute_segment,
+                               attention_window=attention_window)
         self.speller = self.speller.to(DEVICE)
 
-    def forward(self, inputs, targets, teacher_forcing):
+    def forward(self, inputs, targets, teacher_forcing, record_attention=False):
         listener_outputs, outputs_length = self.listener(inputs)
-        probs, predictions, targets_for_loss, targets_length_for_loss, attentions = self.speller(listener_outputs, outputs_length, targets, teacher_forcing)
+        probs, predictions, targets_for_loss, targets_length_for_loss, attentions = self.speller(listener_outputs, outputs_length, targets, teacher_forcing, record_attention)
 
         return probs, predictions, targets_for_loss, targets_length_for_loss, attentions
 
-    def inference(self, inputs, targets):
+    def inference(self, inputs, targets, timestep=None, max_len_ratio=2.0,
+                  beam_width=1, length_penalty=1.0):
         listener_outputs, outputs_length = self.listener(inputs)
-        prediction_list = self.speller.inference(listener_outputs, outputs_length, timestep=500)
+        return self.decode(listener_outputs, outputs_length, timestep, max_len_ratio,
+                           beam_width, length_penalty)
+
+    def decode(self, listener_outputs, outputs_length, timestep=None, max_len_ratio=2.0,
+               beam_width=1, length_penalty=1.0):
+        """
+        Decode precomputed Listener outputs, e.g. from an EncoderCache:
+        greedy for beam_width 1, beam search otherwise.
+        """
+        if beam_width > 1:
+            prediction_list = self.speller.beam_search(listener_outputs, outputs_length, beam_width,
+                                                       length_penalty=length_penalty, timestep=timestep,
+                                                       max_len_ratio=max_len_ratio)
+        else:
+            prediction_list = self.speller.inference(listener_outputs, outputs_length,
+                                                     timestep=timestep, max_len_ratio=max_len_ratio)
         return prediction_list
 
+def load_las(conf, weights_path=None):
+    """
+    Build LAS from a config dict such as config.MODEL_CONFIG, optionally
+    loading the weights of a checkpoint written by checkpoint.CheckpointManager.
+    A config stored in the checkpoint takes precedence over conf, so models
+    of any preset load without naming it; the config used is kept as
+    model.conf.
+    """
+    checkpoint = None
+    if weights_path is not None:
+        checkpoint = torch.load(weights_path, map_location=DEVICE)
+        conf = checkpoint.get('config', conf)
+    model = LAS(conf["input_size"], conf["listener_hidden_size"], conf["nlayers"],
+                conf["speller_hidden_dim"], conf["embedding_dim"],
+                conf["class_size"], conf["key_dim"], conf["value_dim"],
+                conf["batch_size"], frame_stack=conf.get("frame_stack", 1),
+                frontend_dim=conf.get("frontend_dim", 0))
+    if checkpoint is not None:
+        if 'state_dict' in checkpoint:
+            checkpoint = checkpoint['state_dict']
+        model.load_state_dict(checkpoint)
+    model.conf = conf
+    return model.to(DEVICE)
+
 
 if __name__ == "__main__":
     u1 = torch.randn((30,40))
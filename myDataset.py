@@ -1,8 +1,9 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import numpy as np
 
 from torch.utils.data import DataLoader
+from featstore import RaggedStore
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -13,6 +14,12 @@ class myDataset(Dataset):
         if transcripts_path != None:
             self.label = np.load(transcripts_path)
             self.flag = True
+        # lengths used by BucketBatchSampler to group similar utterances
+        self.frame_lengths = np.array([len(utterance) for utterance in self.data])
+        if self.flag is True:
+            self.transcript_lengths = np.array([len(transcript) for transcript in self.label])
+        else:
+            self.transcript_lengths = None
 
     def __len__(self):
         return len(self.data)
@@ -27,6 +34,44 @@ class myDataset(Dataset):
         else:
             return sequence, [-1]
 
+class MappedDataset(Dataset):
+    """
+    myDataset over ragged stores written by featstore.py. Utterances are
+    returned as zero-copy views of the memory-mapped feature file (float16
+    stores are upcast per utterance), so memory does not grow with workers.
+    """
+    def __init__(self, data_prefix, transcripts_prefix):
+        self.data = RaggedStore(data_prefix)
+        self.frame_lengths = self.data.lengths
+        self.flag = False
+        self.transcript_lengths = None
+        if transcripts_prefix != None:
+            self.label = RaggedStore(transcripts_prefix)
+            self.transcript_lengths = self.label.lengths
+            self.flag = True
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        sequence = torch.from_numpy(self.data[index])
+        if sequence.dtype != torch.float32:
+            sequence = sequence.float()
+        if self.flag is True:
+            target = torch.from_numpy(self.label[index])
+            return sequence, target
+        else:
+            return sequence, [-1]
+
+def open_dataset(data_path, transcripts_path, mmap=False):
+    """
+    mmap: the paths are featstore.py ragged store prefixes (MappedDataset),
+    otherwise .npy object arrays (myDataset). transcripts_path may be None.
+    """
+    if mmap is True:
+        return MappedDataset(data_path, transcripts_path)
+    return myDataset(data_path, transcripts_path)
+
 def collate_seq(seq_list):
     inputs, targets = zip(*seq_list)
     lens = [len(seq) for seq in inputs]
@@ -35,6 +80,102 @@ def collate_seq(seq_list):
     targets = [targets[i] for i in seq_order]
     return inputs, targets
 
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups utterances of similar frame and transcript length.
+    Each epoch the indices are shuffled, cut into buckets of
+    batch_size * bucket_size utterances, sorted by length inside a bucket and
+    split into batches, and the batches are shuffled again. With max_frames set,
+    a batch grows until batch_len * longest_frames would exceed max_frames
+    instead of stopping at batch_size.
+    With num_replicas > 1 every rank builds the same batches from the shared
+    seed and keeps every num_replicas-th one, starting at its rank; the list is
+    padded by repeating batches so all ranks run the same number of steps.
+    """
+    def __init__(self, frame_lengths, transcript_lengths=None, batch_size=20,
+                 max_frames=None, bucket_size=50, shuffle=True, seed=0,
+                 num_replicas=1, rank=0):
+        self.frame_lengths = np.asarray(frame_lengths)
+        if transcript_lengths is None:
+            transcript_lengths = np.zeros(len(self.frame_lengths), dtype=np.int64)
+        self.transcript_lengths = np.asarray(transcript_lengths)
+        self.batch_size = batch_size
+        self.max_frames = max_frames
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.last_batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def make_batches(self, epoch):
+        rng = np.random.RandomState(self.seed + epoch)
+        n = len(self.frame_lengths)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+        chunk = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, n, chunk):
+            bucket = order[start:start + chunk]
+            # longest first, transcript length breaks ties
+            bucket = bucket[np.lexsort((-self.transcript_lengths[bucket], -self.frame_lengths[bucket]))]
+            batch = []
+            for index in bucket:
+                if len(batch) > 0:
+                    longest = self.frame_lengths[batch[0]]
+                    if self.max_frames is not None:
+                        full = (len(batch) + 1) * longest > self.max_frames
+                    else:
+                        full = len(batch) == self.batch_size
+                    if full:
+                        batches.append(batch)
+                        batch = []
+                batch.append(int(index))
+            if len(batch) > 0:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def shard(self, batches):
+        if self.num_replicas == 1:
+            return batches
+        padding = -len(batches) % self.num_replicas
+        batches = batches + batches[:padding]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        batches = self.shard(self.make_batches(self.epoch))
+        self.last_batches = batches
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.shard(self.make_batches(self.epoch)))
+
+    def padding_efficiency(self, batches=None):
+        """
+        Fraction of real (non-padding) frames and transcript characters over
+        the given batches, or the batches of the last epoch.
+        return: (frame_efficiency, transcript_efficiency)
+        """
+        if batches is None:
+            batches = self.last_batches if self.last_batches is not None else self.make_batches(self.epoch)
+        real_frames = padded_frames = real_chars = padded_chars = 0
+        for batch in batches:
+            frames = self.frame_lengths[batch]
+            chars = self.transcript_lengths[batch]
+            real_frames += frames.sum()
+            padded_frames += frames.max() * len(batch)
+            real_chars += chars.sum()
+            padded_chars += chars.max() * len(batch)
+        frame_efficiency = real_frames / max(padded_frames, 1)
+        transcript_efficiency = real_chars / max(padded_chars, 1)
+        return float(frame_efficiency), float(transcript_efficiency)
+
 
 if __name__ == '__main__':
     data_path = "./data/dev.npy"
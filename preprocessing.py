@@ -1,77 +1,138 @@
+import argparse
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
-########## Preprocessing Training Dataset ##########
-train_data = np.load("./data/train.npy", encoding='bytes')
-train_label = np.load("./data/train_transcripts.npy", encoding='bytes') # 24724 utterances
-print("train label", len(train_label)) # 1106 utterances
+from featstore import store_paths, write_concatenated
+from vocab import LABEL_MAP
 
-# Convert bytes to string
-for i in range(len(train_label)):
-    train_label[i] = train_label[i].astype(str)
+# Transcripts are object arrays of utterances, each an array of words (bytes).
+# An utterance is encoded as
+#   [<sos>, chars of word 1, <space>, chars of word 2, ..., <eos>]
+# Example:
+#   ['THE', 'FEMALE'] -> [<sos>, 'T', 'H', 'E', <space>, 'F', 'E', 'M', 'A', 'L', 'E', <eos>]
 
-# Create vocabulary list and vocabulary map
-# character-based label
-LABEL_LIST = ['<sos>', '<eos>'] # 34 characters
-LABEL_MAP = {'<eos>': 0, '<sos>': 1}
-for i in range(len(train_label)):
-    for j in range(len(train_label[i])):
-        for char in list(train_label[i][j]):
-            if char not in LABEL_LIST:
-                LABEL_LIST.append(char)
-                LABEL_MAP[char] = len(LABEL_LIST) - 1
-LABEL_LIST.append('<space>')
-LABEL_MAP['<space>'] = len(LABEL_LIST) - 1
-LABEL_LIST = sorted(LABEL_LIST)
-for key in LABEL_MAP.keys():
-    LABEL_MAP[key] = LABEL_LIST.index(key)
+def char_table():
+    """
+    return: int16 array of 256 entries mapping a byte to its LABEL_MAP id,
+            -1 for bytes outside the vocabulary
+    """
+    table = np.full(256, -1, dtype=np.int16)
+    for char, index in LABEL_MAP.items():
+        if len(char) == 1:
+            table[ord(char)] = index
+    table[ord(' ')] = LABEL_MAP['<space>']
+    return table
 
-print(LABEL_LIST)
-print(LABEL_MAP)
+def utterance_bytes(utterance):
+    words = [w.encode() if isinstance(w, str) else bytes(w) for w in utterance]
+    return b' '.join(words)
 
-# Convert transcripts to character-based label
-char_label = []
-for i in range(len(train_label)):
-    tmp_label = []
-    tmp_label.append(LABEL_MAP['<sos>'])
-    for j in range(len(train_label[i])):
-        for k in range(len(list(train_label[i][j]))):
-            key = list(train_label[i][j])[k]
-            tmp_label.append(LABEL_MAP[key])
-        if j != len(train_label[i]) - 1:
-            tmp_label.append(LABEL_MAP['<space>'])
-    tmp_label.append(LABEL_MAP['<eos>'])
-    char_label.append(tmp_label)
+def encode_shard(texts):
+    """
+    texts: list of utterances joined with single spaces (bytes)
+    return: (int8 label array of all utterances, int64 lengths)
+    """
+    table = char_table()
+    lengths = np.array([len(t) for t in texts], dtype=np.int64)
+    chars = table[np.frombuffer(b''.join(texts), dtype=np.uint8)]
+    if (chars < 0).any():
+        unknown = sorted(set(chr(c) for c in np.frombuffer(b''.join(texts), dtype=np.uint8)[chars < 0]))
+        raise ValueError("characters outside vocab.LABEL_MAP: {}".format(unknown))
+    n = len(texts)
+    # every utterance grows by <sos> and <eos>
+    out_lengths = lengths + 2
+    out_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(out_lengths, out=out_offsets[1:])
+    labels = np.empty(out_offsets[-1], dtype=np.int8)
+    labels[out_offsets[:-1]] = LABEL_MAP['<sos>']
+    labels[out_offsets[1:] - 1] = LABEL_MAP['<eos>']
+    utterance_index = np.repeat(np.arange(n), lengths)
+    labels[np.arange(len(chars)) + 2 * utterance_index + 1] = chars
+    return labels, out_lengths
 
-# Save characters-based label to file
-np.save('./data/train_char.npy', np.array(char_label))
+def shard_key(texts):
+    digest = hashlib.sha1(repr(sorted(LABEL_MAP.items())).encode())
+    for text in texts:
+        digest.update(text)
+        digest.update(b'\n')
+    return digest.hexdigest()[:16]
 
-assert len(LABEL_LIST) == len(LABEL_MAP)
-assert len(set(LABEL_LIST)) == len(LABEL_MAP)
+def process_shard(job):
+    """
+    Encode one shard unless a cached result for identical input exists.
+    return: (shard path, whether it was re-encoded)
+    """
+    texts, cache_dir, index = job
+    path = os.path.join(cache_dir, "{:05d}-{}.npz".format(index, shard_key(texts)))
+    if os.path.isfile(path):
+        return path, False
+    labels, lengths = encode_shard(texts)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, labels=labels, lengths=lengths)
+    os.replace(tmp_path, path)
+    return path, True
 
-data = np.load('./data/train_char.npy')
-assert len(data) == len(train_data)
+def preprocess(transcripts_path, prefix, shard_size=2000, workers=None, save_npy=None):
+    """
+    Encode a transcript .npy into an int8 ragged store at prefix (see featstore.py).
+    Shards are cached under <prefix>.shards and only re-encoded when their
+    transcripts change. save_npy additionally writes the object array read by myDataset.
+    """
+    transcripts = np.load(transcripts_path, encoding='bytes', allow_pickle=True)
+    texts = [utterance_bytes(utterance) for utterance in transcripts]
+    cache_dir = prefix + ".shards"
+    os.makedirs(cache_dir, exist_ok=True)
+    jobs = [(texts[i:i + shard_size], cache_dir, i // shard_size)
+            for i in range(0, len(texts), shard_size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(process_shard, jobs))
+    paths = [path for path, _ in results]
+    # remove shards of an earlier corpus that are no longer referenced
+    for name in os.listdir(cache_dir):
+        if os.path.join(cache_dir, name) not in paths:
+            os.remove(os.path.join(cache_dir, name))
 
-########## Preprocessing Validation Dataset ##########
-dev_label = np.load("./data/dev_transcripts.npy", encoding='bytes')
-print("dev label", len(dev_label)) # 1106 utterances
+    labels, lengths = [], []
+    for path in paths:
+        with np.load(path) as shard:
+            labels.append(shard["labels"])
+            lengths.append(shard["lengths"])
+    labels = np.concatenate(labels)
+    lengths = np.concatenate(lengths)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    write_concatenated(labels, offsets, prefix)
+    if save_npy is not None:
+        char_label = np.empty(len(lengths), dtype=object)
+        for i in range(len(lengths)):
+            char_label[i] = labels[offsets[i]:offsets[i + 1]].astype(np.int64)
+        np.save(save_npy, char_label)
+    encoded = sum(1 for _, fresh in results if fresh)
+    print("{}: {} utterances, {}/{} shards encoded -> {}".format(
+        transcripts_path, len(lengths), encoded, len(jobs), store_paths(prefix)[0]))
+    return labels, offsets
 
-# Convert bytes to string
-for i in range(len(dev_label)):
-    dev_label[i] = dev_label[i].astype(str)
+def arguments():
+    parser = argparse.ArgumentParser(description="encode transcripts to character labels")
+    parser.add_argument('--data-dir', type=str, default="./data",
+                        help='directory with <split>_transcripts.npy')
+    parser.add_argument('--splits', type=str, nargs='+', default=["train", "dev"])
+    parser.add_argument('--shard-size', type=int, default=2000,
+                        help='utterances per cached shard')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='encoder processes (default: cpu count)')
+    # train.py reads the .npy labels unless --mmap is given
+    parser.add_argument('--no-npy', dest='npy', action='store_false',
+                        help='skip the <split>_char.npy object arrays read by myDataset')
+    return parser.parse_args()
 
-# Convert transcripts to character-based label
-dev_char_label = []
-for i in range(len(dev_label)):
-    tmp_label = []
-    tmp_label.append(LABEL_MAP['<sos>'])
-    for j in range(len(dev_label[i])):
-        for k in range(len(list(dev_label[i][j]))):
-            key = list(dev_label[i][j])[k]
-            tmp_label.append(LABEL_MAP[key])
-        if j != len(dev_label[i]) - 1:
-            tmp_label.append(LABEL_MAP['<space>'])
-    tmp_label.append(LABEL_MAP['<eos>'])
-    dev_char_label.append(tmp_label)
-
-# Save characters-based label to file
-np.save('./data/dev_char.npy', np.array(dev_char_label))
\ No newline at end of file
+if __name__ == '__main__':
+    args = arguments()
+    for split in args.splits:
+        transcripts_path = os.path.join(args.data_dir, split + "_transcripts.npy")
+        prefix = os.path.join(args.data_dir, split + "_char")
+        save_npy = prefix + ".npy" if args.npy else None
+        preprocess(transcripts_path, prefix, args.shard_size, args.workers, save_npy)
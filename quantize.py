@@ -0,0 +1,81 @@
+import argparse
+import copy
+import os
+# quantized kernels are CPU only
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from config import MODEL_CONFIG as CONF
+from evaluate import decode_dataset
+from metrics import error_rates
+from model import load_las
+from myDataset import open_dataset, collate_seq
+
+QUANTIZED_MODULES = {nn.LSTM, nn.LSTMCell, nn.Linear}
+
+def quantize_las(model):
+    """
+    Dynamic int8 quantization of the Listener BLSTMs, the Speller LSTMCells
+    and every Linear layer. Weights are stored as int8, activations are
+    quantized on the fly. Returns a new model; the input is left untouched.
+    """
+    model = model.to("cpu").eval()
+    return torch.ao.quantization.quantize_dynamic(model, QUANTIZED_MODULES, dtype=torch.qint8)
+
+def save_quantized(model, conf, path):
+    torch.save({'config': conf, 'quantized_state_dict': model.state_dict()}, path)
+
+def load_quantized(path):
+    """
+    Rebuild LAS from the stored config, quantize it and load the int8 weights.
+    """
+    artifact = torch.load(path, map_location="cpu", weights_only=False)
+    model = quantize_las(load_las(artifact['config']))
+    model.load_state_dict(artifact['quantized_state_dict'])
+    return model
+
+def main(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = load_las(CONF, args.weights).eval()
+    quantized = quantize_las(copy.deepcopy(model))
+    save_quantized(quantized, model.conf, args.output)
+    size = os.path.getsize(args.output) / 2 ** 20
+    print("quantized model written to {} ({:.1f} MB)".format(args.output, size))
+
+    dev_set = open_dataset(args.dev_data, args.dev_transcripts, args.mmap)
+    loader = DataLoader(dev_set, shuffle=False, batch_size=args.batch_size, collate_fn=collate_seq)
+    results = {}
+    for name, candidate in (("fp32", model), ("int8", quantized)):
+        hyps, refs, elapsed = decode_dataset(candidate, loader, args.nutterances)
+        cer, wer = error_rates(hyps, refs)
+        results[name] = (elapsed, cer, wer)
+        print("{}: {} utterances in {:.2f}s, CER {:.4f}, WER {:.4f}".format(
+            name, len(hyps), elapsed, cer, wer))
+    print("speedup {:.2f}x, CER change {:+.4f}, WER change {:+.4f}".format(
+        results["fp32"][0] / results["int8"][0],
+        results["int8"][1] - results["fp32"][1],
+        results["int8"][2] - results["fp32"][2]))
+
+def arguments():
+    parser = argparse.ArgumentParser(description="export a dynamically int8-quantized LAS")
+    parser.add_argument('--weights', type=str, required=True,
+                        help='fp32 training checkpoint')
+    parser.add_argument('--output', type=str, default="./weights/las-int8.pth",
+                        help='quantized artifact to write')
+    parser.add_argument('--dev-data', type=str, default="./data/dev.npy")
+    parser.add_argument('--dev-transcripts', type=str, default="./data/dev_char.npy")
+    parser.add_argument('--mmap', action='store_true',
+                        help='dev paths are featstore.py prefixes')
+    parser.add_argument('--nutterances', type=int, default=1106,
+                        help='dev utterances to evaluate')
+    parser.add_argument('--batch-size', type=int, default=CONF["batch_size"])
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch intra-op threads (default: torch default)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
@@ -0,0 +1,227 @@
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+
+from config import MODEL_CONFIG as CONF
+from model import load_las
+from submission import batch_to_text
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+class ServerMetrics(object):
+    """
+    Thread-safe counters for the batcher. Latencies and batch sizes are kept
+    for the most recent `window` requests/batches.
+    """
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+
+    def record_queue_depth(self, depth):
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def record_batch(self, size, queue_waits, latencies):
+        with self.lock:
+            self.batches += 1
+            self.requests += size
+            self.batch_sizes.append(size)
+            self.queue_waits.extend(queue_waits)
+            self.latencies.extend(latencies)
+
+    def snapshot(self, queue_depth):
+        with self.lock:
+            latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+            waits = np.array(self.queue_waits) if len(self.queue_waits) > 0 else np.zeros(1)
+            batch_sizes = np.array(self.batch_sizes) if len(self.batch_sizes) > 0 else np.zeros(1)
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "queue_depth": queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "mean_batch_size": float(batch_sizes.mean()),
+                "max_batch_size": int(batch_sizes.max()),
+                "queue_wait_p50": float(np.percentile(waits, 50)),
+                "latency_p50": float(np.percentile(latencies, 50)),
+                "latency_p99": float(np.percentile(latencies, 99)),
+            }
+
+class DynamicBatcher(object):
+    """
+    Groups concurrent transcription requests into one LAS.inference call.
+    A batch is closed when it holds max_batch requests or when max_wait seconds
+    have passed since its first request arrived.
+    """
+    def __init__(self, model, max_batch=16, max_wait=0.01, inference_kwargs=None):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.inference_kwargs = inference_kwargs or {}
+        self.queue = queue.Queue()
+        self.metrics = ServerMetrics()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, features):
+        """
+        features: n_frames * input_size float32 array
+        return: Future resolving to the decoded string
+        """
+        future = Future()
+        self.queue.put((torch.from_numpy(np.ascontiguousarray(features, dtype=np.float32)),
+                        future, time.perf_counter()))
+        self.metrics.record_queue_depth(self.queue.qsize())
+        return future
+
+    def next_batch(self):
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = item[2] + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        while self.running:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            start = time.perf_counter()
+            # the listener packs sequences, so decode longest first
+            order = sorted(range(len(batch)), key=lambda i: len(batch[i][0]), reverse=True)
+            inputs = [batch[i][0] for i in order]
+            try:
+                with torch.no_grad():
+                    prediction_list = self.model.inference(inputs, None, **self.inference_kwargs)
+                texts = batch_to_text(prediction_list)
+                for j, i in enumerate(order):
+                    batch[i][1].set_result(texts[j])
+            except Exception as error:
+                # fail the requests of this batch, never the batcher thread
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            end = time.perf_counter()
+            self.metrics.record_batch(len(batch),
+                                      [start - arrival for _, _, arrival in batch],
+                                      [end - arrival for _, _, arrival in batch])
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self.send_json(200, batcher.metrics.snapshot(batcher.queue.qsize()))
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            # body: an .npy serialized n_frames * input_size array
+            if self.path != "/transcribe":
+                self.send_json(404, {"error": "not found"})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            listener = batcher.model.listener
+            try:
+                features = np.load(io.BytesIO(self.rfile.read(length)), allow_pickle=False)
+            except Exception:
+                features = None
+            # the Listener reduces shorter inputs to no encoder frames at all,
+            # which would fail every request batched with them
+            if features is None or features.ndim != 2 or features.shape[1] != listener.input_size \
+                    or features.shape[0] < listener.reduction:
+                self.send_json(400, {"error": "expected an .npy array of shape n_frames * {}, "
+                                              "n_frames >= {}".format(listener.input_size, listener.reduction)})
+                return
+            try:
+                text = batcher.submit(features).result()
+            except Exception as error:
+                self.send_json(500, {"error": str(error)})
+                return
+            self.send_json(200, {"text": text})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def serve(model, host, port, max_batch, max_wait, inference_kwargs=None):
+    """
+    Start the batcher and an HTTP server on a background thread.
+    return: (server, batcher); call server.shutdown() and batcher.stop() to stop
+    """
+    batcher = DynamicBatcher(model, max_batch, max_wait, inference_kwargs)
+    batcher.start()
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, batcher
+
+def main(args):
+    model = load_las(CONF, args.weights)
+    model.eval()
+    server, batcher = serve(model, args.host, args.port, args.max_batch, args.max_wait / 1000.0,
+                            {"beam_width": args.beam_width})
+    print("serving on http://{}:{} (POST /transcribe, GET /metrics)".format(*server.server_address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        batcher.stop()
+
+def arguments():
+    parser = argparse.ArgumentParser(description="LAS inference server")
+    parser.add_argument('--weights', type=str, default=None,
+                        help='checkpoint to serve')
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=16,
+                        help='largest dynamic batch')
+    parser.add_argument('--max-wait', type=float, default=10.0,
+                        help='milliseconds a request may wait for its batch to fill')
+    parser.add_argument('--beam-width', type=int, default=1)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = arguments()
+    main(args)
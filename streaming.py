@@ -0,0 +1,181 @@
+import torch
+
+from model import decoding_lengths
+from vocab import LABEL_MAP
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+class StreamingListener(object):
+    """
+    Chunked encoder around a trained Listener for a single live utterance.
+    Frames are buffered as they arrive; once chunk_frames new frames plus
+    lookahead future frames are available, the bidirectional Listener runs over
+    a window of [left_context | chunk | lookahead] frames and the pyramid-reduced
+    frames of the chunk are emitted. Only the window is kept in memory, so
+    memory no longer grows with the length of the audio.
+    All three sizes must be multiples of the Listener's time reduction
+    (frame stacking times pyramid reduction, 8 by default).
+    """
+    def __init__(self, listener, chunk_frames=64, left_context=64, lookahead=32):
+        self.listener = listener
+        self.reduction = listener.reduction
+        for size in (chunk_frames, left_context, lookahead):
+            assert size % self.reduction == 0, "window sizes must be multiples of {}".format(self.reduction)
+        self.chunk_frames = chunk_frames
+        self.left_context = left_context
+        self.lookahead = lookahead
+        self.reset()
+
+    def reset(self):
+        # buffer holds input frames [buffer_start, received)
+        self.buffer = torch.zeros(0, self.listener.input_size)
+        self.buffer_start = 0
+        self.received = 0
+        # number of encoder frames emitted so far
+        self.emitted = 0
+
+    def accept(self, chunk):
+        """
+        chunk: n_frames * input_size
+        return: new_encoder_frames * listener_output_dim (possibly empty)
+        """
+        self.buffer = torch.cat((self.buffer, chunk.float()), dim=0)
+        self.received += len(chunk)
+        return self.encode(final=False)
+
+    def flush(self):
+        """
+        Encode whatever is left at the end of the utterance.
+        """
+        return self.encode(final=True)
+
+    def encode(self, final):
+        outputs = []
+        while True:
+            start = self.emitted * self.reduction
+            end = start + self.chunk_frames
+            if not final and self.received < end + self.lookahead:
+                break
+            # number of whole encoder frames in this chunk
+            n_out = (min(end, self.received) - start) // self.reduction
+            if n_out == 0:
+                break
+            window_start = max(self.buffer_start, start - self.left_context)
+            window_end = min(self.received, end + self.lookahead)
+            window = self.buffer[window_start - self.buffer_start:window_end - self.buffer_start]
+            listener_output, _ = self.listener([window])
+            offset = (start - window_start) // self.reduction
+            outputs.append(listener_output[0, offset:offset + n_out])
+            self.emitted += n_out
+
+        # drop frames that no later window can reach
+        keep_from = max(self.buffer_start, self.emitted * self.reduction - self.left_context)
+        self.buffer = self.buffer[keep_from - self.buffer_start:]
+        self.buffer_start = keep_from
+        if len(outputs) == 0:
+            return torch.zeros(0, self.listener.lstm_list[-1].hidden_size * 2, device=DEVICE)
+        return torch.cat(outputs, dim=0)
+
+
+class StreamingSpeller(object):
+    """
+    Incremental greedy decoder around a trained Speller. Keys and values of
+    new encoder frames are projected once and appended to the attention cache.
+    A decoded character is only committed if its attention peak lies at least
+    lookahead encoder frames before the newest frame and it is not <eos>;
+    otherwise the step is discarded and retried when more frames arrive.
+    After flush all remaining characters are decoded up to <eos>.
+    """
+    def __init__(self, speller, lookahead=2, max_len_ratio=2.0):
+        self.speller = speller
+        self.lookahead = lookahead
+        self.max_len_ratio = max_len_ratio
+        self.reset()
+
+    def reset(self):
+        self.key = None
+        self.value = None
+        self.attention_mask = None
+        self.state = self.speller.initial_state(1)
+        self.context = None
+        self.preds = torch.full((1,), LABEL_MAP['<sos>'], dtype=torch.long, device=DEVICE)
+        self.tokens = []
+        self.done = False
+
+    def extend(self, encoder_frames):
+        """
+        encoder_frames: n * listener_output_dim, output of StreamingListener
+        """
+        if len(encoder_frames) == 0:
+            return
+        key, value, attention_mask = self.speller.attention.project(
+            encoder_frames.unsqueeze(0), [len(encoder_frames)])
+        if self.key is None:
+            self.key, self.value, self.attention_mask = key, value, attention_mask
+        else:
+            self.key = torch.cat((self.key, key), dim=2)
+            self.value = torch.cat((self.value, value), dim=1)
+            self.attention_mask = torch.cat((self.attention_mask, attention_mask), dim=2)
+
+    def decode(self, final=False):
+        """
+        return: list of newly committed character ids
+        """
+        new_tokens = []
+        if self.done or self.key is None:
+            return new_tokens
+        nframes = self.key.shape[2]
+        if self.context is None:
+            self.context, _ = self.speller.attention.attend(
+                self.state[2], self.key, self.value, self.attention_mask)
+        max_len = int(decoding_lengths([nframes], max_len_ratio=self.max_len_ratio)[0])
+        while len(self.tokens) < max_len:
+            embed = self.speller.embed(self.preds)
+            prob_linear, context, attention, state = self.speller.step(
+                embed, self.context, self.state, self.key, self.value, self.attention_mask)
+            preds = torch.argmax(prob_linear, dim=1)
+            pred = int(preds[0])
+            if not final:
+                if len(state) > 4:
+                    # windowed attention: the peak is kept in the state
+                    peak = int(state[4][0])
+                else:
+                    peak = int(torch.argmax(attention[0, 0]))
+                if pred == LABEL_MAP['<eos>'] or peak >= nframes - self.lookahead:
+                    # wait for more audio before committing this step
+                    return new_tokens
+            if pred == LABEL_MAP['<eos>']:
+                self.done = True
+                return new_tokens
+            self.preds, self.context, self.state = preds, context, state
+            self.tokens.append(pred)
+            new_tokens.append(pred)
+        if final:
+            self.done = True
+        return new_tokens
+
+
+class StreamingRecognizer(object):
+    """
+    Glue between StreamingListener and StreamingSpeller for one utterance.
+    """
+    def __init__(self, model, chunk_frames=64, left_context=64, lookahead=32,
+                 decoder_lookahead=2, max_len_ratio=2.0):
+        self.listener = StreamingListener(model.listener, chunk_frames, left_context, lookahead)
+        self.speller = StreamingSpeller(model.speller, decoder_lookahead, max_len_ratio)
+
+    def reset(self):
+        self.listener.reset()
+        self.speller.reset()
+
+    def accept(self, chunk):
+        """
+        chunk: n_frames * input_size
+        return: list of newly committed character ids
+        """
+        self.speller.extend(self.listener.accept(chunk))
+        return self.speller.decode(final=False)
+
+    def flush(self):
+        self.speller.extend(self.listener.flush())
+        return self.speller.decode(final=True)
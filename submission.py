@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+
+from vocab import NUM_2_CHAR, LABEL_MAP, VOCAB_SIZE
+
+def char_codes():
+    """
+    Lookup table from label id to ASCII code; <sos> and <eos> map to 0 and are
+    dropped, <space> maps to ' '.
+    """
+    table = np.zeros(VOCAB_SIZE, dtype=np.uint8)
+    for label, char in NUM_2_CHAR.items():
+        if label not in (LABEL_MAP['<sos>'], LABEL_MAP['<eos>']):
+            table[label] = ord(char)
+    return table
+
+CHAR_CODES = char_codes()
+
+def batch_to_text(prediction_list):
+    """
+    prediction_list: list of 1d LongTensors, e.g. from LAS.inference
+    return: list of strings. The batch is copied to the host once and mapped
+    through CHAR_CODES in one indexing operation.
+    """
+    if len(prediction_list) == 0:
+        return []
+    lengths = [len(prediction) for prediction in prediction_list]
+    ids = torch.cat([prediction.reshape(-1) for prediction in prediction_list]).cpu().numpy()
+    codes = CHAR_CODES[ids]
+    keep = codes != 0
+    # characters left per utterance once <sos>/<eos> are dropped
+    utterance = np.repeat(np.arange(len(lengths)), lengths)
+    counts = np.bincount(utterance[keep], minlength=len(lengths))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    text = codes[keep].tobytes().decode("ascii")
+    return [text[start:end] for start, end in zip(starts, ends)]
+
+class SubmissionWriter(object):
+    """
+    Writes "id,transcript" rows as batches are decoded instead of buffering
+    the whole test set; ids count up from 0 in the order rows are written.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.count = 0
+
+    def write(self, texts):
+        rows = ["{},{}\n".format(self.count + i, text) for i, text in enumerate(texts)]
+        self.file.write("".join(rows))
+        self.count += len(texts)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
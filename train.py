@@ -1,108 +1,133 @@
 import argparse
+import contextlib
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 import torch.nn as nn
 import os
-import matplotlib.pyplot as plt
 
-from myDataset import myDataset, collate_seq
-from config import MODEL_CONFIG as CONF
-from model import LAS
-from vocab import NUM_2_CHAR
+from myDataset import open_dataset, collate_seq, BucketBatchSampler
+from config import PRESETS
+from model import LAS, load_las, sequence_loss, distillation_loss
+from submission import SubmissionWriter, batch_to_text
+from instrumentation import NULL_MONITOR, TrainingMonitor
+from attention_store import AttentionRecorder
+from checkpoint import CheckpointManager, save_weights
+from evaluate import evaluate, eval_subset, metrics_pool
+from distributed import launch, init_worker, is_main_process, cleanup, unwrap
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-print(DEVICE)
 
-def train(train_loader, model, optimizer, criterion, epoch):
-    for step, (inputs, targets) in enumerate(train_loader):
-        torch.cuda.empty_cache()
-        optimizer.zero_grad()
-        probs, predictions, targets_for_loss, targets_length_for_loss, \
-        attentions = model(inputs, targets, teacher_forcing=0.2)
+def autocast_context(precision):
+    """
+    precision: "fp32", "bf16" (CPU or CUDA autocast) or "fp16" (CUDA autocast,
+    used together with a GradScaler)
+    """
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float16
+    return torch.autocast(device_type=DEVICE, dtype=dtype)
 
-        perplexity = 0
-        loss = 0
+def train(train_loader, model, optimizer, criterion, epoch, monitor=NULL_MONITOR,
+          precision="fp32", scaler=None, accumulation_steps=1, checkpoints=None,
+          checkpoint_every=0, recorder=None, teacher=None, distill_weight=0.5,
+          distill_temperature=1.0):
+    """
+    Gradients of accumulation_steps consecutive micro-batches are summed before
+    each optimizer step, so the effective batch is accumulation_steps times the
+    loader batch while memory stays that of one micro-batch. Under
+    DistributedDataParallel the gradient all-reduce only runs on the last
+    micro-batch of each accumulation and on the last micro-batch of the epoch,
+    so a trailing partial accumulation is reduced as well. Attentions are only
+    kept on the steps the recorder samples.
+    With a frozen teacher LAS the loss is (1 - distill_weight) * cross entropy
+    + distill_weight * distillation_loss against the teacher's probs. Both
+    models are then fed the ground truth characters, so their outputs are
+    conditioned on the same prefixes.
+    """
+    if scaler is None:
+        scaler = torch.amp.GradScaler(enabled=False)
+    optimizer.zero_grad()
+    pending = 0
+    nsteps = len(train_loader)
+    teacher_forcing = 0.2 if teacher is None else 1.0
+    for step, (inputs, targets) in enumerate(monitor.wrap_loader(train_loader)):
+        monitor.begin_step(epoch, step, inputs, targets)
+        torch.cuda.empty_cache()
+        sync = pending + 1 == accumulation_steps or step + 1 == nsteps \
+            or not isinstance(model, DistributedDataParallel)
+        record = recorder is not None and recorder.wants(step)
+        with contextlib.nullcontext() if sync else model.no_sync():
+            with autocast_context(precision):
+                probs, predictions, targets_for_loss, targets_length_for_loss, \
+                attentions = model(inputs, targets, teacher_forcing=teacher_forcing, record_attention=record)
 
-        for i in range(len(targets_for_loss)): # for i in range(batch_size)
-            for j in range(targets_length_for_loss[i]): # for j in range(time_step - 1)
-                loss = loss + criterion(probs[i,j,:].unsqueeze(dim=0), targets_for_loss[i,j].unsqueeze(dim=0))
+                if teacher is not None:
+                    with monitor.phase("teacher"), torch.no_grad():
+                        teacher_probs = teacher(inputs, targets, teacher_forcing=1.0)[0]
+                with monitor.phase("loss"):
+                    loss, ntokens = sequence_loss(probs, targets_for_loss, targets_length_for_loss, criterion)
+                    if teacher is not None:
+                        soft_loss = distillation_loss(probs, teacher_probs, targets_length_for_loss,
+                                                      distill_temperature)
+                        loss = (1 - distill_weight) * loss + distill_weight * soft_loss
 
-        loss.backward()
-        optimizer.step()
+            with monitor.phase("backward"):
+                scaler.scale(loss).backward()
+        pending += 1
+        if record:
+            encoder_lengths = unwrap(model).listener.output_lengths(torch.LongTensor([len(u) for u in inputs]))
+            recorder.record(epoch, step, attentions, encoder_lengths, targets_length_for_loss)
+            del attentions
+        if pending == accumulation_steps:
+            with monitor.phase("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+            pending = 0
         perplexity = np.exp(loss.item() / len(targets_for_loss) / max(targets_length_for_loss))
-        if step % 10 == 0:
-            print("epoch {}, step {}, loss per step {}, perplexity {}, finish {}".format(
-                epoch, step, loss/len(inputs), perplexity, (step+1)*len(inputs)))
-        if (step+1) % args.checkpoint == 0:
-            save_model(epoch, model, optimizer, loss, step, "./weights/")
-
-def attention_map(dev_loader, model):
-    for step, (inputs, targets) in enumerate(dev_loader):
-        if step == 0:
-            torch.cuda.empty_cache()
-            probs, predictions, targets_for_loss, targets_length_for_loss, \
-            attentions = model(inputs, targets, teacher_forcing=0.9)
-            attentions_tensor = torch.cat(attentions, dim=1)
-            print(attentions_tensor.shape)
-            data = attentions_tensor[0]
-            print(data.shape)
-            plt.imshow(data.cpu().detach().numpy(), cmap='hot')
-            plt.show()
-            plt.savefig('am.jpg')
-            break
+        monitor.end_step(loss=loss.item(), perplexity=perplexity)
+        if step % 10 == 0 and is_main_process():
+            print("epoch {}, step {}, loss per step {}, loss per token {}, perplexity {}, finish {}".format(
+                epoch, step, loss/len(inputs), loss.item()/ntokens, perplexity, (step+1)*len(inputs)))
+        if checkpoints is not None and (step+1) % checkpoint_every == 0:
+            checkpoints.save(epoch, step, unwrap(model), optimizer, loss.item() / ntokens)
+    if pending > 0:
+        # flush the gradients of a trailing partial accumulation
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
 
 def dev(dev_loader, model, optimizer, criterion, pathname):
-    p = []
-    for step, (inputs, targets) in enumerate(dev_loader):
-        torch.cuda.empty_cache()
-        optimizer.zero_grad()
-        prediction_list = model.inference(inputs, targets)
-        batch_size = len(prediction_list)
-        for i in range(batch_size):
-            pred = ""
-            for j in range(len(prediction_list[i])):
-                pred += NUM_2_CHAR[int(prediction_list[i][j].to("cpu"))]
-            print("pred: ", pred)
-            # target = ""
-            # for j in range(len(targets[i])):
-                # target += NUM_2_CHAR[int(targets[i][j].to("cpu"))]
-            # print("target", target)
-            p.append(pred)
-    p = np.array(p)
-    with open(pathname, 'w') as f:
-        for i in range(len(p)):
-            f.write(str(i) + "," + p[i] + "\n")
-
-
-def save_model(epoch, model, optimizer, loss, step, save_path):
-    filename = save_path + str(epoch) + '-' + str(step) + '-' + "%.6f" % loss.item() + '.pth'
-    print('Save model at Train Epoch: {} [Step: {}\tLoss: {:.12f}]'.format(
-        epoch, step, loss.item()))
-    state = {
-        'epoch': epoch + 1,
-        'state_dict': model.state_dict(),
-        'optimizer': optimizer.state_dict(),
-        'loss': loss
-    }
-    torch.save(state, filename)
-
-def load_model(epoch, step, loss, model, optimizer, save_path):
-    filename = save_path + str(epoch) + '-' + str(step) + '-' + str(loss) + '.pth'
-    if os.path.isfile(filename):
-        print("######### loading weights ##########")
-        checkpoint = torch.load(filename)
-        start_epoch = checkpoint['epoch']
-        model.load_state_dict(checkpoint['state_dict'])
-        optimizer.load_state_dict(checkpoint['optimizer'])
-        loss = checkpoint['loss']
-        print('########## loading weights done ##########')
-        return model, optimizer, start_epoch, loss
-    else:
-        print("no such file: ", filename)
+    """
+    Decode dev_loader in order and stream "id,transcript" rows to pathname.
+    """
+    with SubmissionWriter(pathname) as writer, torch.no_grad():
+        for step, (inputs, targets) in enumerate(dev_loader):
+            torch.cuda.empty_cache()
+            prediction_list = model.inference(inputs, targets)
+            texts = batch_to_text(prediction_list)
+            for pred in texts:
+                print("pred: ", pred)
+            writer.write(texts)
 
 def main(args):
+    launch(worker, args.world_size, (args,))
+
+def worker(rank, world_size, args):
+    """
+    One training process. With world_size > 1 the model is wrapped in
+    DistributedDataParallel over gloo, every rank trains on its shard of the
+    batches and rank 0 alone logs, checkpoints and writes the submission.
+    """
+    init_worker(rank, world_size, args.threads)
+    if is_main_process():
+        print(DEVICE)
+    if world_size > 1 and DEVICE == "cuda":
+        raise ValueError("distributed training uses the gloo backend on CPU; hide the GPUs with CUDA_VISIBLE_DEVICES=''")
     # Load configuration
+    CONF = PRESETS[args.preset]
     input_size = CONF["input_size"]
     listener_hidden_size = CONF["listener_hidden_size"]
     nlayers = CONF["nlayers"]
@@ -112,50 +137,106 @@ def main(args):
     key_dim = CONF["key_dim"]
     value_dim = CONF["value_dim"]
     batch_size = CONF["batch_size"]
+    # loader batches are micro-batches; the optimizer sees accumulation_steps of them
+    micro_batch_size = args.micro_batch_size if args.micro_batch_size > 0 else batch_size
 
-    train_path = "./data/train.npy"
-    train_transcripts_path = "./data/train_char.npy"
-    train_set = myDataset(train_path, train_transcripts_path)
-    train_loader = DataLoader(train_set, shuffle=True, batch_size=batch_size, collate_fn=collate_seq, num_workers=4)
+    # with --mmap the paths are prefixes of ragged stores written by featstore.py
+    suffix = "" if args.mmap is True else ".npy"
+    train_set = open_dataset("./data/train" + suffix, "./data/train_char" + suffix, args.mmap)
+    dev_set = open_dataset("./data/dev" + suffix, "./data/dev_char" + suffix, args.mmap)
+    test_set = open_dataset("./data/test" + suffix, None, args.mmap)
+    if args.bucket_size > 0:
+        max_frames = args.max_frames if args.max_frames > 0 else None
+        train_sampler = BucketBatchSampler(train_set.frame_lengths, train_set.transcript_lengths,
+                                           batch_size=micro_batch_size, max_frames=max_frames,
+                                           bucket_size=args.bucket_size,
+                                           num_replicas=world_size, rank=rank)
+        train_loader = DataLoader(train_set, batch_sampler=train_sampler, collate_fn=collate_seq, num_workers=4)
+    elif world_size > 1:
+        train_sampler = DistributedSampler(train_set, num_replicas=world_size, rank=rank, shuffle=True)
+        train_loader = DataLoader(train_set, sampler=train_sampler, batch_size=micro_batch_size, collate_fn=collate_seq, num_workers=4)
+    else:
+        train_sampler = None
+        train_loader = DataLoader(train_set, shuffle=True, batch_size=micro_batch_size, collate_fn=collate_seq, num_workers=4)
 
-    dev_path = "./data/dev.npy"
-    dev_transcripts_path = "./data/dev_char.npy"
-    dev_set = myDataset(dev_path, dev_transcripts_path)
     dev_loader = DataLoader(dev_set, shuffle=False, batch_size=batch_size, collate_fn=collate_seq, num_workers=4)
+    eval_loader = DataLoader(eval_subset(dev_set, args.eval_utterances), shuffle=False,
+                             batch_size=batch_size, collate_fn=collate_seq, num_workers=4)
 
-    test_path = "./data/test.npy"
-    test_set = myDataset(test_path, None)
     test_loader = DataLoader(test_set, shuffle=False, batch_size=1, collate_fn=collate_seq, num_workers=4)
 
     model = LAS(input_size, listener_hidden_size, nlayers,
                 speller_hidden_dim, embedding_dim,
-                class_size, key_dim, value_dim, batch_size)
+                class_size, key_dim, value_dim, batch_size,
+                recompute_listener=args.recompute_listener,
+                recompute_segment=args.recompute_segment,
+                attention_window=args.attention_window,
+                frame_stack=CONF["frame_stack"], frontend_dim=CONF["frontend_dim"])
     model = model.to(DEVICE)
 
     optimizer = torch.optim.Adam(model.parameters(),
                 lr=args.lr, weight_decay=args.weight_decay)
     criterion = nn.CrossEntropyLoss(reduction="sum")
+    if args.precision == "fp16" and DEVICE != "cuda":
+        raise ValueError("fp16 training needs CUDA; use --precision bf16 on CPU")
+    # loss scaling only matters for fp16, whose gradients can underflow
+    scaler = torch.amp.GradScaler(DEVICE, enabled=args.precision == "fp16")
 
     start_epoch = 0
     nepochs = args.epochs
-    if args.resume is True:
-            model, optimizer, start_epoch, loss = load_model(
-                args.load_epoch,
-                args.load_step,
-                args.load_loss,
-                model,
-                optimizer,
-                "./weights/"
-            )
-    # model.eval()
-    # attention_map(dev_loader, model)
+    checkpoints = CheckpointManager(args.weights_path, keep_last=args.keep_checkpoints, config=CONF)
+    if args.resume is not None:
+        resumed = checkpoints.load(args.resume, model, optimizer)
+        if resumed is not None:
+            start_epoch, loss = resumed
+            if is_main_process():
+                print("resuming at epoch {} from {} (loss per token {:.4f})".format(start_epoch, args.resume, loss))
+    if args.metrics_log is not None and is_main_process():
+        monitor = TrainingMonitor(args.metrics_log, model, args.profile_steps, args.profile_dir)
+    else:
+        monitor = NULL_MONITOR
+    teacher = None
+    if args.teacher is not None:
+        # the teacher's config is read from its checkpoint when stored there
+        teacher = load_las(PRESETS[args.teacher_preset], args.teacher).eval()
+        teacher.requires_grad_(False)
+    recorder = None
+    if args.attention_every > 0 and is_main_process():
+        recorder = AttentionRecorder(args.attention_dir, args.attention_every,
+                                     args.attention_utterances, args.attention_step_stride)
+    eval_pool = None
+    if args.eval_every > 0 and is_main_process():
+        eval_pool = metrics_pool(args.eval_workers)
+    if world_size > 1:
+        # parameters are broadcast from rank 0, gradients are averaged in backward
+        model = DistributedDataParallel(model)
     for epoch in range(start_epoch, nepochs):
         model.train()
-        train(train_loader, model, optimizer, criterion, epoch)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        train(train_loader, model, optimizer, criterion, epoch, monitor,
+              args.precision, scaler, args.accumulation_steps,
+              checkpoints if is_main_process() else None, args.checkpoint, recorder,
+              teacher, args.distill_weight, args.distill_temperature)
+        if isinstance(train_sampler, BucketBatchSampler) and is_main_process():
+            print("epoch {}, padding efficiency: frames {:.3f}, transcripts {:.3f}".format(
+                epoch, *train_sampler.padding_efficiency()))
+        if eval_pool is not None and (epoch + 1) % args.eval_every == 0:
+            cer, wer, nutterances, elapsed = evaluate(unwrap(model), eval_loader, eval_pool)
+            print("epoch {}, dev CER {:.4f}, WER {:.4f} on {} utterances ({:.1f}s)".format(
+                epoch, cer, wer, nutterances, elapsed))
         # model.eval()
         # eval()
-    model.eval()
-    dev(test_loader, model, optimizer, criterion, "submission.csv")
+    monitor.close()
+    checkpoints.close()
+    if eval_pool is not None:
+        eval_pool.shutdown()
+    if is_main_process():
+        model = unwrap(model)
+        save_weights(model, CONF, os.path.join(args.weights_path, "las-weights.pth"))
+        model.eval()
+        dev(test_loader, model, optimizer, criterion, "submission.csv")
+    cleanup()
 
 def arguments():
     parser = argparse.ArgumentParser(description="LAS")
@@ -168,16 +249,64 @@ def arguments():
                         help="learning rate")
     parser.add_argument('--checkpoint', type=int, default=610, metavar="R",
                         help='checkpoint to save model parameters')
-    parser.add_argument('--resume', type=bool, default=False, metavar="R",
-                        help='resume training from saved weight')
+    parser.add_argument('--resume', type=str, default=None, metavar="R",
+                        help='resume training from "latest", "best" or a checkpoint path')
+    parser.add_argument('--keep-checkpoints', type=int, default=3,
+                        help='most recent checkpoints kept besides the best one')
+    parser.add_argument('--preset', type=str, default="base", choices=sorted(PRESETS),
+                        help='model size from config.PRESETS')
+    parser.add_argument('--teacher', type=str, default=None,
+                        help='frozen teacher checkpoint to distill from')
+    parser.add_argument('--teacher-preset', type=str, default="base", choices=sorted(PRESETS),
+                        help='teacher size when its checkpoint stores no config')
+    parser.add_argument('--distill-weight', type=float, default=0.5,
+                        help='weight of the distillation loss against the cross entropy')
+    parser.add_argument('--distill-temperature', type=float, default=2.0,
+                        help='softmax temperature of teacher and student in the distillation loss')
+    parser.add_argument('--precision', type=str, default="fp32", choices=["fp32", "bf16", "fp16"],
+                        help='autocast precision: bf16 on CPU or CUDA, fp16 with loss scaling on CUDA')
+    parser.add_argument('--micro-batch-size', type=int, default=0,
+                        help='utterances per forward/backward (default: config batch_size)')
+    parser.add_argument('--accumulation-steps', type=int, default=1,
+                        help='micro-batches whose gradients are summed per optimizer step')
+    parser.add_argument('--recompute-listener', action='store_true',
+                        help='recompute Listener activations in backward to save memory')
+    parser.add_argument('--recompute-segment', type=int, default=0,
+                        help='recompute Speller steps in backward, keeping state every N steps (0 disables)')
+    parser.add_argument('--attention-every', type=int, default=0,
+                        help='record attention maps every N steps for attention_viewer.py (0 disables)')
+    parser.add_argument('--attention-utterances', type=int, default=1,
+                        help='utterances of a recorded batch that are kept')
+    parser.add_argument('--attention-step-stride', type=int, default=1,
+                        help='keep every N-th decoder step of a recorded attention map')
+    parser.add_argument('--attention-dir', type=str, default="./attention",
+                        help='where recorded attention maps are written')
+    parser.add_argument('--eval-every', type=int, default=0,
+                        help='compute dev CER/WER every N epochs (0: off)')
+    parser.add_argument('--eval-utterances', type=int, default=200,
+                        help='size of the fixed dev subset evaluated during training (0: all)')
+    parser.add_argument('--eval-workers', type=int, default=2,
+                        help='processes computing edit distances during evaluation')
+    parser.add_argument('--world-size', type=int, default=1,
+                        help='data-parallel training processes on this machine (gloo, CPU)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch intra-op threads per process (default: cores / world size)')
+    parser.add_argument('--attention-window', type=int, default=0,
+                        help='attend to N encoder frames around the previous peak (0: full attention)')
+    parser.add_argument('--mmap', action='store_true',
+                        help='read memory-mapped stores written by featstore.py instead of .npy')
+    parser.add_argument('--bucket-size', type=int, default=0,
+                        help='batches per length bucket in the train sampler, e.g. 50 (0: shuffled batches)')
+    parser.add_argument('--max-frames', type=int, default=0,
+                        help='with --bucket-size, cap train batches by padded frames instead of batch size (0 disables)')
+    parser.add_argument('--metrics-log', type=str, default=None,
+                        help='per-step timing/throughput/memory log (.jsonl or .csv)')
+    parser.add_argument('--profile-steps', type=int, nargs=2, default=None, metavar=("START", "END"),
+                        help='record a torch.profiler trace for global steps [START, END)')
+    parser.add_argument('--profile-dir', type=str, default="./profile",
+                        help='where profiler traces are written')
     parser.add_argument('--weights-path', type=str, default="./weights/",
                         help='path to save weights')
-    parser.add_argument('-load-epoch', type=str, default=0, metavar="LE",
-                        help='number of epoch to be loaded')
-    parser.add_argument('-load-step', type=str, default=0, metavar="LS",
-                        help='number of step to be loaded')
-    parser.add_argument('-load-loss', type=str, default=0, metavar="LL",
-                        help='loss item to be loaded')
 
     return parser.parse_args()
 